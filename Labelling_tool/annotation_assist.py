@@ -0,0 +1,127 @@
+import queue
+import threading
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torchvision.transforms as transforms
+from PIL import Image
+
+
+class AnnotationAssistant:
+    """ Runs a TorchScript frame-score model (e.g. a traced CNNConStn) over a us sequence on a worker thread and derives
+    a labelling queue from its predictions: frames that are near duplicates of an earlier frame are left out and the
+    remaining frames are ordered by the entropy of the predicted class distribution, most uncertain first. Frames
+    predicted with high confidence get the pathology labels mapped to their class as suggestions, which the annotator
+    can accept in bulk.
+    """
+
+    def __init__(self, model_file, class_labels, img_size=224, batch_size=32, confidence=0.9, duplicate_threshold=0.02):
+        """
+        :param model_file: (string) The TorchScript frame model, returning the class logits (or a (logits, ...) tuple)
+        :param class_labels: (dict) The pathology labels suggested for a predicted class, e.g. {0: ['Normal']}
+        :param img_size: (int) The input size of the model
+        :param batch_size: (int) The number of frames per forward
+        :param confidence: (float) The minimum probability of the predicted class for a suggestion
+        :param duplicate_threshold: (float) The mean absolute difference of the 16x16 gray signatures (0-1) below which
+        a frame is a near duplicate of the previous kept frame
+        """
+        self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.model = torch.jit.load(model_file, map_location=self.device)
+        self.model.eval()
+        self.class_labels = {int(predicted_class): labels for predicted_class, labels in class_labels.items()}
+        self.img_size = img_size
+        # The test transform of the frame model (frame-score-predictor/utils/tranforms.py) applied to PIL frames
+        self.transform = transforms.Compose([transforms.Resize((img_size, img_size)), transforms.ToTensor()])
+        self.batch_size = batch_size
+        self.confidence = confidence
+        self.duplicate_threshold = duplicate_threshold
+        self.results = queue.Queue()
+        self.cancelled = threading.Event()
+
+    def analyse(self, video_number, frames):
+        """ Starts the analysis of a us sequence, cancelling the running one. The result is handed over through take
+
+        :param video_number: (int) The video number the result belongs to
+        :param frames: (list) The RGB frames, e.g. a LazyDicomFrames
+        :return:
+        """
+        self.cancelled.set()
+        self.cancelled = threading.Event()
+        threading.Thread(target=self.run, args=(video_number, frames, self.cancelled), daemon=True).start()
+
+    def take(self, video_number):
+        """ Returns the analysis of a us sequence without blocking
+
+        :param video_number: (int) The video number
+        :return: result (dict) The 'order' of the frames to label, the 'suggestions' per frame and the 'probabilities',
+        None while the analysis is running
+        """
+        while True:
+            try:
+                result_video, result = self.results.get_nowait()
+            except queue.Empty:
+                return None
+            if result_video == video_number:
+                return result
+
+    def run(self, video_number, frames, cancelled):
+        probabilities = []
+        signatures = []
+        with torch.no_grad():
+            for start in range(0, len(frames), self.batch_size):
+                if cancelled.is_set():
+                    return
+                batch = np.stack([frames[i] for i in range(start, min(start + self.batch_size, len(frames)))])
+                signatures.append(frame_signatures(batch))
+                probabilities.append(self.predict(batch))
+        probabilities = np.concatenate(probabilities)
+        signatures = np.concatenate(signatures)
+        entropy = -np.sum(probabilities * np.log(np.clip(probabilities, 1e-12, None)), axis=1)
+        kept = near_duplicate_representatives(signatures, self.duplicate_threshold)
+        order = kept[np.argsort(-entropy[kept], kind='stable')]
+        predicted = probabilities.argmax(axis=1)
+        suggestions = {int(frame): self.class_labels[int(predicted[frame])] for frame in np.flatnonzero(probabilities.max(axis=1) >= self.confidence)
+                       if int(predicted[frame]) in self.class_labels}
+        if not cancelled.is_set():
+            self.results.put((video_number, {'order': order.tolist(), 'suggestions': suggestions, 'probabilities': probabilities}))
+
+    def predict(self, batch):
+        """ Class probabilities of a batch of frames, resized and scaled to 0-1 as in the test transform of the frame model
+
+        :param batch: (nparray) The (frames, rows, columns, 3) uint8 frames
+        :return: probabilities (nparray) The (frames, classes) probabilities
+        """
+        x = torch.stack([self.transform(Image.fromarray(frame).convert('RGB')) for frame in batch]).to(self.device)
+        logits = self.model(x)
+        if isinstance(logits, tuple):
+            logits = logits[0]
+        logits = logits[:batch.shape[0]]  # CNNConStn stacks the logits of its two transformed inputs
+        return F.softmax(logits, dim=1).cpu().numpy()
+
+
+def frame_signatures(frames, size=16):
+    """ Gray size x size block means of frames, scaled to 0-1, for near duplicate detection
+
+    :param frames: (nparray) The (frames, rows, columns, 3) uint8 frames
+    :param size: (int) The signature side
+    :return: signatures (nparray) The (frames, size * size) signatures
+    """
+    rows, columns = frames.shape[1] // size * size, frames.shape[2] // size * size
+    gray = frames[:, :rows, :columns].mean(axis=3, dtype=np.float32)
+    blocks = gray.reshape(frames.shape[0], size, rows // size, size, columns // size).mean(axis=(2, 4))
+    return blocks.reshape(frames.shape[0], -1) / 255
+
+
+def near_duplicate_representatives(signatures, threshold):
+    """ Frames kept when consecutive near duplicates are collapsed: a frame is kept when its signature differs from the
+    last kept frame by at least threshold
+
+    :param signatures: (nparray) The (frames, features) signatures
+    :param threshold: (float) The mean absolute difference below which frames are near duplicates
+    :return: kept (nparray) The indices of the kept frames
+    """
+    kept = [0]
+    for frame in range(1, len(signatures)):
+        if np.abs(signatures[frame] - signatures[kept[-1]]).mean() >= threshold:
+            kept.append(frame)
+    return np.array(kept[:len(signatures)], dtype=int)
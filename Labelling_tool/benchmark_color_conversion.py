@@ -0,0 +1,41 @@
+import argparse
+import time
+import numpy as np
+import pydicom.pixel_data_handlers.util
+from load_images_from_dicom import us_image_converting, convert_ybr_to_rgb, decode_volume
+
+# Compares the per-frame pydicom color conversion with the vectorized volume conversion, on a DICOM file or on a
+# random YBR clip, checking that both give the same RGB frames
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--dicom_file", default=None, help="Without a DICOM file a random clip is converted")
+parser.add_argument("--frames", default=300, type=int)
+parser.add_argument("--rows", default=720, type=int)
+parser.add_argument("--columns", default=960, type=int)
+parser.add_argument("--chunk_pixels", default=65536, type=int)
+args = parser.parse_args()
+
+if args.dicom_file:
+    volume = decode_volume(args.dicom_file)
+else:
+    volume = np.random.default_rng(0).integers(0, 256, (args.frames, args.rows, args.columns, 3), dtype=np.uint8)
+print('Volume', volume.shape)
+
+start = time.perf_counter()
+reference = [us_image_converting(volume[i]) for i in range(volume.shape[0])]
+per_frame_time = time.perf_counter() - start
+
+out = np.empty_like(volume)
+start = time.perf_counter()
+convert_ybr_to_rgb(volume, out=out, chunk_pixels=args.chunk_pixels)
+vectorized_time = time.perf_counter() - start
+
+in_place = volume.copy()
+start = time.perf_counter()
+convert_ybr_to_rgb(in_place, out=in_place, chunk_pixels=args.chunk_pixels)
+in_place_time = time.perf_counter() - start
+
+mismatches = sum(int(np.count_nonzero(reference[i] != out[i])) for i in range(volume.shape[0]))
+print('Per frame (pydicom): %.2f s' % per_frame_time)
+print('Vectorized: %.2f s (%.1fx), in place: %.2f s (%.1fx)' % (vectorized_time, per_frame_time / vectorized_time, in_place_time, per_frame_time / in_place_time))
+print('Values differing from pydicom: %d, in place equal to out of place: %s' % (mismatches, np.array_equal(in_place, out)))
@@ -0,0 +1,180 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from pydicom import dcmread
+from dicom_index import scan_dicom_folder
+from load_images_from_dicom import decode_volume, convert_ybr_to_rgb
+
+# Builds the frame-score-predictor dataset (<dataset_root>/frames/*.npy and dataset.pkl) from labelled DICOM folders.
+# Only the labelled frames are written. A manifest records, per video, the DICOM modification time and size and a hash
+# of its labels, so a re-run only decodes the videos that are new or whose file or labels changed.
+
+SENSORS = {'LINEAR': 'linear', 'CURVED LINEAR': 'convex', 'CONVEX': 'convex'}
+
+
+def read_frame_labels(folder_name):
+    """ Reads the frame labels written by LabelGUI for a folder. When several frame_info CSVs exist, the most recent
+    one wins for the videos it contains
+
+    :param folder_name: (string) The labelled folder
+    :return: frame_labels (dict) The pathology label text per frame for every video, keyed by the video path relative to the folder
+    """
+    frame_labels = {}
+    for frame_file in sorted(glob.glob(os.path.join(folder_name, 'frame_info_*.csv')), key=os.path.getmtime):
+        frame_info = pd.read_csv(frame_file, index_col=0, keep_default_na=False)
+        for video_file, labels in frame_info.groupby('video file', sort=False)['pathology label']:
+            frame_labels[relative_video_path(video_file, folder_name)] = labels.tolist()
+    return frame_labels
+
+
+def relative_video_path(video_file, folder_name):
+    # The CSVs store the path of the folder as it was opened in the GUI, which may have moved since
+    folder_name = os.path.normpath(folder_name)
+    video_file = os.path.normpath(video_file)
+    if video_file.startswith(folder_name + os.sep):
+        return os.path.relpath(video_file, folder_name)
+    return os.path.basename(video_file)
+
+
+def frame_scores(labels, score_map):
+    """ The score of every frame as the highest score of its pathology labels, None for unlabelled frames
+
+    :param labels: (list) The pathology label text per frame, labels separated by ', '
+    :param score_map: (dict) The score of every pathology label
+    :return: scores (list) The score per frame
+    """
+    scores = []
+    for label_text in labels:
+        names = [name for name in label_text.split(', ') if name]
+        unknown = [name for name in names if name not in score_map]
+        if unknown:
+            raise Exception('No score for the labels: ' + ', '.join(unknown))
+        scores.append(max(score_map[name] for name in names) if names else None)
+    return scores
+
+
+def process_video(video_file, frame_prefix, scores, max_score, frames_dir):
+    """ Decodes a DICOM video and writes its labelled frames as RGB .npy files. Runs in a worker process
+
+    :param video_file: (string) The DICOM file
+    :param frame_prefix: (string) The file name prefix of the frames of this video
+    :param scores: (list) The score per frame, None for frames that are not written
+    :param max_score: (int) The highest score, the length of the label lists
+    :param frames_dir: (string) The output folder of the frames
+    :return: rows (list) A dataset.pkl row per written frame
+    """
+    header = dcmread(video_file, stop_before_pixels=True)
+    patient = str(header.get('PatientID', '')) or os.path.basename(os.path.dirname(video_file))
+    patient_hash = hashlib.md5(patient.encode()).hexdigest()
+    sensor = SENSORS.get(str(header.get('TransducerType', '')).upper(), 'unknown')
+    volume = decode_volume(video_file)
+    if volume.ndim == 3:
+        volume = volume[np.newaxis]
+    if len(scores) != volume.shape[0]:
+        raise Exception('{} has {} frames but {} labelled frames'.format(video_file, volume.shape[0], len(scores)))
+    convert_ybr_to_rgb(volume, out=volume)
+    rows = []
+    for frame, score in enumerate(scores):
+        if score is None:
+            continue
+        filename = '{}_{:04d}.npy'.format(frame_prefix, frame)
+        np.save(os.path.join(frames_dir, filename), volume[frame])
+        rows.append({'filename': filename, 'label': [1] * score + [0] * (max_score - score), 'sensor': sensor,
+                     'patient_hash': patient_hash, 'video': video_file, 'frame': frame})
+    return rows
+
+
+def write_outputs(dataset_root, manifest):
+    """ Writes dataset.pkl and the manifest through temporary files, so an interrupted run keeps the finished videos
+
+    :param dataset_root: (string) The dataset folder
+    :param manifest: (dict) The manifest entry of every video
+    :return:
+    """
+    rows = [row for entry in manifest.values() for row in entry['rows']]
+    dataset = pd.DataFrame(rows, columns=['filename', 'label', 'sensor', 'patient_hash', 'video', 'frame'])
+    dataset.to_pickle(os.path.join(dataset_root, 'dataset.pkl.tmp'))
+    os.replace(os.path.join(dataset_root, 'dataset.pkl.tmp'), os.path.join(dataset_root, 'dataset.pkl'))
+    with open(os.path.join(dataset_root, 'build_manifest.json.tmp'), 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(os.path.join(dataset_root, 'build_manifest.json.tmp'), os.path.join(dataset_root, 'build_manifest.json'))
+
+
+def remove_frames(frames_dir, entry):
+    for row in entry['rows']:
+        frame_path = os.path.join(frames_dir, row['filename'])
+        if os.path.exists(frame_path):
+            os.remove(frame_path)
+
+
+def build_dataset(folders, dataset_root, score_map, workers=4, checkpoint_every=20):
+    """ Builds or updates the dataset from labelled DICOM folders
+
+    :param folders: (list) The labelled DICOM folders
+    :param dataset_root: (string) The dataset folder, frames are written to its frames subfolder
+    :param score_map: (dict) The score of every pathology label
+    :param workers: (int) The number of processes decoding videos
+    :param checkpoint_every: (int) The number of processed videos after which dataset.pkl is rewritten
+    :return: dataset (DataFrame) The dataset.pkl table
+    """
+    frames_dir = os.path.join(dataset_root, 'frames')
+    os.makedirs(frames_dir, exist_ok=True)
+    manifest_path = os.path.join(dataset_root, 'build_manifest.json')
+    previous = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as manifest_file:
+            previous = json.load(manifest_file)
+    max_score = max(score_map.values())
+
+    manifest = {}
+    jobs = []
+    for folder_name in folders:
+        frame_labels = read_frame_labels(folder_name)
+        for entry in scan_dicom_folder(folder_name):
+            labels = frame_labels.get(relative_video_path(entry['path'], folder_name))
+            if labels is None:
+                continue  # Not labelled yet
+            video_file = os.path.abspath(entry['path'])
+            scores = frame_scores(labels, score_map)
+            key = {'mtime_ns': entry['mtime_ns'], 'size': entry['size'],
+                   'labels': hashlib.md5(json.dumps([scores, max_score]).encode()).hexdigest()}
+            old_entry = previous.pop(video_file, None)
+            if old_entry is not None and old_entry['key'] == key:
+                manifest[video_file] = old_entry
+                continue
+            if old_entry is not None:
+                remove_frames(frames_dir, old_entry)
+            frame_prefix = '{}_{}'.format(os.path.basename(video_file), hashlib.md5(video_file.encode()).hexdigest()[:8])
+            jobs.append((video_file, key, (video_file, frame_prefix, scores, max_score, frames_dir)))
+    for old_entry in previous.values():  # Videos that were removed or lost their labels
+        remove_frames(frames_dir, old_entry)
+    print('{} videos up to date, {} to process, {} removed'.format(len(manifest), len(jobs), len(previous)))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [(video_file, key, executor.submit(process_video, *arguments)) for video_file, key, arguments in jobs]
+        for done, (video_file, key, future) in enumerate(futures, 1):
+            manifest[video_file] = {'key': key, 'rows': future.result()}
+            print('Processed {} ({} / {})'.format(video_file, done, len(futures)))
+            if done % checkpoint_every == 0:
+                write_outputs(dataset_root, manifest)
+    write_outputs(dataset_root, manifest)
+    return pd.read_pickle(os.path.join(dataset_root, 'dataset.pkl'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Builds the frame-score-predictor dataset from folders labelled with LabelGUI.')
+    parser.add_argument('folders', nargs='+', help='Labelled DICOM folders')
+    parser.add_argument('--dataset_root', default='../dataset', help='Output folder for frames/*.npy and dataset.pkl')
+    parser.add_argument('--score_map', required=True, help='JSON file with the score of every pathology label, e.g. {"Normal": 0, "B-lines": 1}')
+    parser.add_argument('--workers', default=4, type=int, help='Number of decoding processes')
+    parser.add_argument('--checkpoint_every', default=20, type=int, help='Videos after which dataset.pkl is rewritten')
+    args = parser.parse_args()
+    with open(args.score_map) as score_map_file:
+        score_map = json.load(score_map_file)
+    dataset = build_dataset(args.folders, args.dataset_root, score_map, args.workers, args.checkpoint_every)
+    print('{} frames of {} videos in {}'.format(len(dataset), dataset['video'].nunique(), args.dataset_root))
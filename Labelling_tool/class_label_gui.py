@@ -2,11 +2,13 @@ import tkinter
 import tkinter.font as tkFont
 
 import os
+import time
+from collections import deque
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from get_files_with_extension import get_files_with_extension, get_files_without_extension
-from load_images_from_dicom import get_list_of_images_from_dicom_file
-import pandas as pd
+from dicom_index import scan_dicom_folder
+from load_images_from_dicom import LazyDicomFrames, SequencePrefetcher
+from label_journal import LabelJournal
 from functools import partial
 import numpy as np
 
@@ -15,13 +17,17 @@ class LabelGUI:
             self, master,
             first_video: int,
             dicom_data_path: str,
-            file_extension: str = ""
+            file_extension: str = "",
+            assist_model: str = None,
+            assist_labels: dict = None
     ):
         """LabelGUI class generates a GUI to allow assessment of images
         # Arguments:
             first_video (int): integer that indicates at which video file the process should start.
             dicom_data_path (str): main path where the DICOM files are stored
             file_extension (str): extension of the DICOM files containing the images.
+            assist_model (str): TorchScript frame model that orders the frames and suggests labels, None to label all frames in order.
+            assist_labels (dict): labels suggested for the frames predicted as a class with high confidence, e.g. {0: ['Normal']}.
         """
         # self.label_mode = 'multiple'
 
@@ -31,11 +37,7 @@ class LabelGUI:
         self.labelling_buttons = []
         self.frame_num = 0 # start at the first frame of the US sequence
         self.master = master
-        self.video_number = first_video
         self.dicom_data_path = dicom_data_path
-        self.video_info = pd.DataFrame(columns=['video file', 'scan location'])
-        self.frame_info = pd.DataFrame(columns=['video file', 'pathology label'])
-        self.frame_index_start = 0  # The index at which the current video is starting in self.frame_info
         self.us_scan_positions = ('RANT', 'LANT', 'LPL',  'RPL', 'LPU', 'RPU')
         self.pathology_labels = ['Normal', 'Collapse', 'Consolidation', 'APO / Int. Syndrome', 'Pneumothorax', 'Effusion', 'B-lines', 'Pleural thickening', 'Irregular pleura']
         self.label_mode = tkinter.StringVar()  # StringVar needed for radio buttons
@@ -45,17 +47,44 @@ class LabelGUI:
         self.figure = plt.figure(figsize=np.array((9.6, 7.2))*1.1)  # Resolution of the images we are using is 960x720, this should be done dynamically based on the image input size
         self.figure.set_tight_layout(True)
         self.buttonwidth = 20  # Fits the currently used text for the buttons
-
-        self.create_output_filename()
+        self.playing = False  # Cine playback of the us sequence
+        self.default_frame_rate = 25  # Used for cine playback when the DICOM header has no frame rate
 
         # Getting and storing DICOM file names
-        self.dicom_file_names = get_files_without_extension(self.dicom_data_path)  # Dicom files often have no extension
-        self.dicom_file_names.extend(get_files_with_extension(self.dicom_data_path, 'dcm'))  # Files with Dicom extension .dcm
+        self.dicom_index = scan_dicom_folder(self.dicom_data_path)  # Dicom files are recognised by their header, with or without extension
+        self.dicom_file_names = [entry['path'] for entry in self.dicom_index]
         print(self.dicom_file_names)
-        self.video_info.loc[:, 'video file'] = self.dicom_file_names
+        self.open_label_journal()
+        self.video_number = self.journal.first_unfinished_video(first_video)  # Skip the videos finished in a previous session
+        self.prefetcher = SequencePrefetcher(self.dicom_file_names)  # Loads the next us sequence in the background
+        self.loading = False
+        self.assistant = None
+        if assist_model:
+            from annotation_assist import AnnotationAssistant  # Needs torch, which is only required in the assisted mode
+            self.assistant = AnnotationAssistant(assist_model, assist_labels or {})
+        self.frame_order = None  # Labelling order from the assistant, frames are labelled in sequence until it is available
+        self.visited_frames = set()  # Frames the annotator moved on from in the current us sequence
+        self.frame_history = []  # Frames shown before the current one in the current us sequence, most recent last
+        self.suggestions = {}
+        self.assistant_text = ''
 
         self.init_GUI()
 
+    def open_label_journal(self):
+        """ Opens the label journal of the folder, resuming the labels and output file names of a previous session when
+        the journal exists
+
+        :return:
+        """
+        suffix = os.path.split(self.dicom_data_path)[-1]
+        journal_file = os.path.join(self.dicom_data_path, 'label_journal_' + suffix + '.jsonl')
+        self.journal = LabelJournal(journal_file, self.dicom_file_names, self.pathology_labels)
+        if self.journal.output_files is None:
+            self.create_output_filename()
+            self.journal.set_output_files(self.frame_output_file, self.video_output_file)
+        else:
+            self.frame_output_file, self.video_output_file = self.journal.output_files
+
     def create_output_filename(self):
         """ Creates an unique name for the output files such that they are not overwritten
         TODO refactor this function to a generic one and remove it from the class
@@ -95,10 +124,11 @@ class LabelGUI:
         # Create plotting canvas
         self.canvas = FigureCanvasTkAgg(self.figure, master=self.master)
         self.canvas.get_tk_widget().grid(row=0, column=0, rowspan=50, columnspan=3)
+        self.canvas.mpl_connect('draw_event', self.cache_background)  # Full redraws, e.g. after a resize, renew the blitting background
+        self.add_standard_buttons()
         self.init_data_for_us_sequence()
         self.plot_frame()
 
-        self.add_standard_buttons()
         self.label_text_font = tkFont.Font(family='Segoe UI', size=12)
         self.label_text_font_bold = tkFont.Font(family='Segoe UI', size=12, weight='bold')
         self.label_text = tkinter.Label(master=self.master, text='', font=self.label_text_font, bg='white')  # Initialize text label below the figure without text
@@ -107,18 +137,77 @@ class LabelGUI:
 
         self.scan_pos_question_components = self.go_to_scan_position_question()  # Start with confirming the scanning position
 
-    def init_data_for_us_sequence(self):
+    def init_data_for_us_sequence(self, frames=None):
         """ Set the necessary variable when loading a new us sequence
 
+        :param frames: (LazyDicomFrames) The prefetched frames of the us sequence, opened here when not given
         :return:
         """
-        self.frames = get_list_of_images_from_dicom_file(self.dicom_file_names[self.video_number])
-        self.frame_index_start = self.frame_info.shape[0]  # The start of the index is the current size of the frame_info DataFrame
-        self.frame_index = self.generate_frame_index(self.frame_index_start, len(self.frames))  # the number of indexes is equal to the amount of frames
-        frame_index_df = pd.DataFrame(columns=['video file'], data=[self.dicom_file_names[self.video_number]] * len(self.frames))  # create dataframe with the video name for frame_info
-        self.frame_info = self.frame_info.append(frame_index_df).fillna('')  # fill all other columns than video_file with an empty string
-        self.frame_info.reset_index(drop=True, inplace=True)
+        if hasattr(self, 'frames'):
+            self.frames.close()  # Stop reading ahead in the previous us sequence
+        if frames is None:
+            frames = LazyDicomFrames(self.dicom_file_names[self.video_number])  # Frames are decoded when they are shown
+        self.frames = frames
+        self.prefetcher.prefetch(self.video_number + 1)  # Load the next us sequence while this one is labelled
+        self.journal.open_video(self.dicom_file_names[self.video_number], len(self.frames))  # Keeps the labels of a resumed video
         self.frame_num = 0  # Start at the first frame of the sequence
+        self.frame_order = None
+        self.visited_frames = set()
+        self.frame_history = []
+        self.suggestions = {}
+        self.assistant_text = ''
+        if self.assistant is not None:
+            self.assistant.analyse(self.video_number, self.frames)
+            self.master.after(100, self.poll_assistant, self.video_number)
+
+    def poll_assistant(self, video_number):
+        """ Picks up the frame order and label suggestions once the assistant has analysed the us sequence
+
+        :param video_number: (int) The video number the assistant is analysing
+        :return:
+        """
+        if video_number != self.video_number:
+            return  # The annotator moved on to another us sequence
+        result = self.assistant.take(video_number)
+        if result is None:
+            self.master.after(100, self.poll_assistant, video_number)
+            return
+        self.frame_order = result['order']
+        self.suggestions = result['suggestions']
+        self.assistant_text = '\n{} frames queued, {} near duplicates skipped\n{} suggestions (a to accept)'.format(
+            len(self.frame_order), len(self.frames) - len(self.frame_order), len(self.suggestions))
+        self.update_frame()
+
+    def get_next_frame_number(self):
+        """ The frame shown after the current one: the first frame of the assistant's order that is not labelled and was not
+        visited yet when the order is available, the next frame of the sequence otherwise. The whole order is searched, so
+        the frames ranked before the current one when the order arrived are labelled as well.
+
+        :return: (int) The frame number, None when the us sequence is done
+        """
+        if self.frame_order is None:
+            return self.frame_num + 1 if self.frame_num < len(self.frames) - 1 else None
+        file = self.dicom_file_names[self.video_number]
+        for frame in self.frame_order:
+            if frame != self.frame_num and frame not in self.visited_frames and not self.journal.get_labels(file, frame):
+                return frame
+        return None
+
+    def accept_suggestions(self):
+        """ Stores the suggested labels of all frames of the us sequence that have no labels yet
+
+        :return:
+        """
+        self.save_multiple_labels()
+        file = self.dicom_file_names[self.video_number]
+        accepted = [(frame, labels) for frame, labels in self.suggestions.items() if not self.journal.get_labels(file, frame)]
+        self.journal.set_labels_many(file, accepted)
+        self.restore_color_of_label_buttons()
+        self.update_labels_attribute()
+        for pathology in self.labels:
+            self.highlight_label_button(pathology)
+        self.label_text.configure(text='{} suggested labels accepted'.format(len(accepted)))
+        self.update_frame()
 
     def show_loading_text(self):
         """ Show text when a new US sequence is loaded
@@ -137,44 +226,131 @@ class LabelGUI:
         """
         self.loading_text.destroy()
 
-    def init_for_next_us_sequence(self):
+    def init_for_next_us_sequence(self, frames=None):
         """ Go back to the initial view of the GUI for the next us sequence
 
+        :param frames: (LazyDicomFrames) The prefetched frames of the us sequence
         :return:
         """
-        self.init_data_for_us_sequence()
+        self.init_data_for_us_sequence(frames)
         self.destroy_list_of_GUI_components(self.labelling_buttons)  # Destroy the existing GUI components (in this case the components in the labelling view)
         self.scan_pos_question_components = self.go_to_scan_position_question()
 
-    def generate_frame_index(self, current, no_frames):
-        """ Creates a new index range
-
-        :param current: (int) start of the range
-        :param no_frames: (int) the length of the range
-        :return:
-        """
-        return range(current, current + no_frames)
-
     def plot_frame(self):
         """ Plot a frame of the us sequence onto the GUI canvas
 
         :return:
         """
         plt.gca()
-        plt.imshow(self.frames[self.frame_num], aspect='equal')  # Assumption of square pixels
+        plt.imshow(self.frames[self.frame_num], aspect='equal', animated=True)  # Assumption of square pixels, animated images are left to update_frame
         plt.xticks([])  # No ticks needed for an image
         plt.yticks([])  # No ticks needed for an image
-        plt.title('Frame {} / {}'.format(self.frame_num + 1, len(self.frames)))
-        self.canvas.draw()  # Needed to update the display
+        self.canvas.draw()  # Draws the axes and caches them as background in cache_background
+        self.update_frame()
+
+    def cache_background(self, event):
+        """ Stores the figure without the image after a full redraw, so that update_frame only has to draw the image
+
+        :param event: (DrawEvent) The matplotlib draw event
+        :return:
+        """
+        axes = self.figure.axes[0]
+        self.background = self.canvas.copy_from_bbox(axes.bbox)
+        axes.draw_artist(axes.images[0])
+        self.canvas.blit(axes.bbox)
 
     def update_frame(self):
-        """ Updates the GUI canvas with a new frame
+        """ Updates the GUI canvas with a new frame by blitting only the image onto the cached background
+
+        :return:
+        """
+        axes = self.figure.axes[0]
+        axes.images[0].set_array(self.frames[self.frame_num])  # Update the data of the figure for speed
+        self.canvas.restore_region(self.background)
+        axes.draw_artist(axes.images[0])
+        self.canvas.blit(axes.bbox)  # Only the image area is copied to the display
+        frame_text = 'Frame {} / {}'.format(self.frame_num + 1, len(self.frames))
+        if self.playing and len(self.display_times) > 1:
+            frame_text += '\n{:.1f} fps of {:.1f}, {} dropped'.format((len(self.display_times) - 1) / (self.display_times[-1] - self.display_times[0]),
+                                                                   1 / self.get_frame_time(), self.dropped_frames)
+        if self.frame_num in self.suggestions:
+            frame_text += '\nSuggested: ' + ', '.join(self.suggestions[self.frame_num])
+        self.frame_text.configure(text=frame_text + self.assistant_text)
+
+    def get_frame_time(self):
+        """ The time between two frames of the us sequence in seconds, from the frame time or frame rate in the DICOM header
 
         :return:
         """
-        self.figure.axes[0].images[0].set_array(self.frames[self.frame_num])  # Update the data of the figure for speed
-        plt.title('Frame {} / {}'.format(self.frame_num + 1, len(self.frames)))
-        self.canvas.draw()  # Needed to update the display
+        entry = self.dicom_index[self.video_number]
+        if entry.get('FrameTime'):
+            return entry['FrameTime'] / 1000  # Frame time is in milliseconds
+        for frame_rate in (entry.get('CineRate'), entry.get('RecommendedDisplayFrameRate')):
+            if frame_rate:
+                return 1 / frame_rate
+        return 1 / self.default_frame_rate
+
+    def toggle_cine(self):
+        """ Starts or pauses the cine playback
+
+        :return:
+        """
+        if self.playing:
+            self.pause_cine()
+        else:
+            self.play_cine()
+
+    def play_cine(self):
+        """ Plays the us sequence from the current frame at the DICOM frame rate
+
+        :return:
+        """
+        if self.loading or self.frame_num == len(self.frames) - 1:
+            return
+        self.save_multiple_labels()  # Labels are not changed during playback
+        self.restore_color_of_label_buttons()
+        self.playing = True
+        self.play_button.configure(text='Pause (p)')
+        self.cine_start = (time.perf_counter(), self.frame_num)
+        self.display_times = deque(maxlen=30)  # Display times of the last frames for the frames/sec readout
+        self.dropped_frames = 0
+        self.cine_step()
+
+    def cine_step(self):
+        """ Shows the frame that is due at the current time and schedules the next one. When drawing falls behind the
+        frame rate, the frames that are already late are dropped instead of slowing down the playback
+
+        :return:
+        """
+        start_time, start_frame = self.cine_start
+        frame_time = self.get_frame_time()
+        due_frame = min(start_frame + int((time.perf_counter() - start_time) / frame_time), len(self.frames) - 1)
+        if due_frame > self.frame_num:
+            self.dropped_frames += due_frame - self.frame_num - 1
+            self.frame_history.append(self.frame_num)
+            self.frame_num = due_frame
+            self.update_frame()
+            self.display_times.append(time.perf_counter())
+        if self.frame_num == len(self.frames) - 1:
+            self.pause_cine()  # Stop at the last frame
+        else:
+            delay = start_time + (self.frame_num + 1 - start_frame) * frame_time - time.perf_counter()
+            self.cine_job = self.master.after(max(1, int(delay * 1000)), self.cine_step)
+
+    def pause_cine(self):
+        """ Stops the cine playback at the current frame and shows its labels
+
+        :return:
+        """
+        if not self.playing:
+            return
+        self.playing = False
+        self.master.after_cancel(self.cine_job)
+        self.play_button.configure(text='Play (p)')
+        self.update_labels_attribute()
+        for pathology in self.labels:
+            self.highlight_label_button(pathology)
+        self.update_frame()
 
     def add_standard_buttons(self):
         """ Add buttons that are used in every view of the GUI
@@ -188,6 +364,7 @@ class LabelGUI:
         std_button_frame.rowconfigure(0, pad=5)
         std_button_frame.rowconfigure(1, pad=5)
         std_button_frame.rowconfigure(2, pad=5)
+        std_button_frame.rowconfigure(3, pad=5)
 
         # Next and previous frame buttons
         next_frame_button = tkinter.Button(master=std_button_frame, height=1, width=self.buttonwidth, text="Next Frame (l)",
@@ -202,6 +379,18 @@ class LabelGUI:
                                      command=lambda: self.save_data())
         save_button.grid(row=2, column=4)
 
+        # Cine playback button and frame counter with the playback frames/sec
+        self.play_button = tkinter.Button(master=std_button_frame, height=1, width=self.buttonwidth, text="Play (p)",
+                                          command=lambda: self.toggle_cine())
+        self.play_button.grid(row=3, column=4)
+        self.frame_text = tkinter.Label(master=std_button_frame, text='', background='white')
+        self.frame_text.grid(row=4, column=4)
+
+        if self.assistant is not None:
+            accept_button = tkinter.Button(master=std_button_frame, height=1, width=self.buttonwidth, text="Accept suggestions (a)",
+                                           command=lambda: self.accept_suggestions())
+            accept_button.grid(row=5, column=4)
+
         # Label mode selection radio buttons
         label_mode_frame = tkinter.Frame(self.master, background='white')
         label_mode_frame.grid(column=4, row=5, padx=10, sticky='w')
@@ -222,16 +411,15 @@ class LabelGUI:
 
         :return:
         """
-        if self.label_mode.get() == 'multiple':
-            if len(self.labels) > 0:
-                multiple_label_text = ', '.join(self.labels)  # Create a string
-                # The label text is printed in process_label_button_press for the single label mode
-                self.frame_info.loc[self.frame_index[self.frame_num], 'pathology label'] = multiple_label_text
-                self.print_labelling_text(multiple_label_text)
+        self.pause_cine()
+        self.save_multiple_labels()
 
-        if self.frame_num < (len(self.frames)-1):  # Go to the next frame if it is not the last one of the us sequence
+        self.visited_frames.add(self.frame_num)
+        next_frame_num = self.get_next_frame_number()
+        if next_frame_num is not None:  # Go to the next frame if it is not the last one of the us sequence
             self.restore_color_of_label_buttons()
-            self.frame_num += 1
+            self.frame_history.append(self.frame_num)
+            self.frame_num = next_frame_num
             self.update_labels_attribute()  # To color buttons according to labels that were already done
             for pathology in self.labels:
                 self.highlight_label_button(pathology)
@@ -239,15 +427,28 @@ class LabelGUI:
         else:
             self.go_to_next_us_sequence()  # Go to the next us sequence if it is the last frame of the us sequence
 
+    def save_multiple_labels(self):
+        """ Saves the labels selected for the current frame in multiple label mode
+
+        :return:
+        """
+        if self.label_mode.get() == 'multiple':
+            if len(self.labels) > 0:
+                # The label text is printed in process_label_button_press for the single label mode
+                multiple_label_text = self.journal.set_labels(self.dicom_file_names[self.video_number], self.frame_num, self.labels)
+                self.print_labelling_text(multiple_label_text)
+
     def previous_frame(self):
-        """ Go to the previous frame in the video and color the label buttons accordingly
+        """ Go back to the frame shown before the current one in the video, which is not the previous frame of the sequence
+        when the assistant's order is followed, and color the label buttons accordingly
         # TODO Support going back to the last frame of the previous video
 
         :return:
         """
-        if self.frame_num > 0:
+        self.pause_cine()
+        if self.frame_history:
             self.restore_color_of_label_buttons()  # Go back to the default button color
-            self.frame_num -= 1
+            self.frame_num = self.frame_history.pop()
             self.update_labels_attribute()
             for pathology in self.labels:  # Highlights the buttons of labels added to the frame previously
                 self.highlight_label_button(pathology)
@@ -258,29 +459,42 @@ class LabelGUI:
 
         :return:
         """
-        pathology_labels = self.frame_info.loc[self.frame_index[self.frame_num], 'pathology label']
-
-        if len(pathology_labels) == 0:
-            self.labels = []
-        else:
-            # Convert the string fromthe frame_info DataFrame back to a list
-            pathology_labels = pathology_labels.replace(' ', '', 1)
-            self.labels = pathology_labels.split(',')
+        self.labels = self.journal.get_labels(self.dicom_file_names[self.video_number], self.frame_num)
 
     def go_to_next_us_sequence(self):
         """ Loads the next video or exits the GUI after the last video
 
         :return:
         """
-        self.save_data() # To not lose data after a complete video has been labelled
+        if self.loading:
+            return  # The next us sequence is already being loaded
+        self.journal.finish_video(self.dicom_file_names[self.video_number])  # The labels are already in the journal
         if self.video_number == len(self.dicom_file_names)-1:
+            self.save_data()
             self.done()  # prepare to exit the program
         else:
             self.video_number += 1
-            self.show_loading_text()
-            self.init_for_next_us_sequence()
+            self.loading = True
+            self.master.unbind("<Key>")  # No frame steps in the finished us sequence while waiting
+            self.wait_for_us_sequence()
+
+    def wait_for_us_sequence(self):
+        """ Shows the next us sequence once the prefetcher has loaded it, polling from the Tk event loop so that the GUI
+        does not freeze while it is loading
+
+        :return:
+        """
+        frames = self.prefetcher.take(self.video_number)
+        if frames is None:
+            if not hasattr(self, 'loading_text') or not self.loading_text.winfo_exists():
+                self.show_loading_text()
+            self.master.after(20, self.wait_for_us_sequence)
+            return
+        self.init_for_next_us_sequence(frames)
+        if hasattr(self, 'loading_text'):
             self.remove_loading_text()
-            self.update_frame()
+        self.loading = False
+        self.update_frame()
 
     def go_to_scan_position_question(self):
         """ Go to the GUI view to confirm the scanning location
@@ -339,7 +553,7 @@ class LabelGUI:
         """
         self.destroy_scan_pos_question()
         view = self.get_US_scan_location()
-        self.video_info.loc[self.video_number, 'scan location'] = view
+        self.journal.set_scan_location(self.dicom_file_names[self.video_number], view)
         self.go_to_labelling_view()
 
     def reject_us_scan_position(self):
@@ -427,7 +641,7 @@ class LabelGUI:
         :param view: (string) the us scan position
         :return:
         """
-        self.video_info.loc[self.video_number, 'scan location'] = view
+        self.journal.set_scan_location(self.dicom_file_names[self.video_number], view)
         for button in self.scan_buttons:
             button.destroy()
         self.go_to_labelling_view()
@@ -448,6 +662,10 @@ class LabelGUI:
             self.next_frame()
         elif event.char == 'k':
             self.previous_frame()
+        elif event.char == 'p':
+            self.toggle_cine()
+        elif event.char == 'a' and self.assistant is not None:
+            self.accept_suggestions()
 
     def process_key_press_view_selection(self, event):
         """ Process a key press for the scan position question view
@@ -459,6 +677,8 @@ class LabelGUI:
             self.next_frame()
         elif event.char == 'k':
             self.previous_frame()
+        elif event.char == 'p':
+            self.toggle_cine()
 
     def process_label_button_press(self, pathology):
         """ Process akey press in the labelling view
@@ -473,7 +693,7 @@ class LabelGUI:
             else:
                 print('This label has already been added to this frame')
         else:
-            self.frame_info.loc[self.frame_index[self.frame_num], 'pathology label'] = pathology
+            self.journal.set_labels(self.dicom_file_names[self.video_number], self.frame_num, [pathology])
             self.print_labelling_text(pathology)
             self.next_frame()
 
@@ -503,12 +723,11 @@ class LabelGUI:
         self.label_text2.grid(row=51, column=1, sticky='W')
 
     def save_data(self):
-        """ Export the data in the DataFrames to a csv
+        """ Export the labels in the journal to the csv files
 
         :return:
         """
-        self.frame_info.to_csv(os.path.join(self.dicom_data_path, self.frame_output_file))
-        self.video_info.to_csv(os.path.join(self.dicom_data_path, self.video_output_file))
+        self.journal.compact()
 
     def get_US_scan_location(self):
         """ Retrieves the us scan location based on the filename
@@ -550,6 +769,10 @@ class LabelGUI:
 
         :return:
         """
+        self.prefetcher.cancel()
+        self.frames.close()
+        self.save_data()
+        self.journal.close()
         self.master.destroy()
 
     def clean_exit_prompt(self):
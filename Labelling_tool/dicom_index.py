@@ -0,0 +1,128 @@
+import json
+import os
+from fnmatch import fnmatch
+from concurrent.futures import ThreadPoolExecutor
+from pydicom import dcmread
+
+# Header tags read for every DICOM file with the type they are stored as in the index, the pixel data is not read
+HEADER_TAGS = {'NumberOfFrames': int, 'Rows': int, 'Columns': int, 'PhotometricInterpretation': str,
+               'FrameTime': float, 'CineRate': int, 'RecommendedDisplayFrameRate': float}
+
+# Files the labelling tool writes into the data folder, they are rewritten every session and never indexed
+OUTPUT_FILES = ('dicom_index_*.json', 'label_journal_*.jsonl', 'frame_info_*.csv', 'video_info_*.csv', '*.tmp')
+
+
+def scan_dicom_folder(folder_name, index_file=None, workers=8):
+    """ Finds all DICOM files in a folder with a single walk of the tree and reads their headers. Files are recognised
+    as DICOM by the DICM magic after the 128 byte preamble, whatever their extension. The result is cached in
+    index_file, keyed by path, modification time and size, so only new or changed files are opened on the next scan.
+    Files found not to be DICOM are only opened again when their size changes, the files written by the tool are skipped.
+
+    :param folder_name: (string) The folder that is scanned, including its subfolders
+    :param index_file: (string) The cache file, by default dicom_index_<folder>.json in the folder
+    :param workers: (int) The number of threads walking subfolders and reading headers
+    :return: dicom_index (list) A dictionary per DICOM file with its path and header tags, sorted by path
+    """
+    if index_file is None:
+        index_file = os.path.join(folder_name, 'dicom_index_' + os.path.split(folder_name)[-1] + '.json')
+    cached = read_index(index_file)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        files = list_files(folder_name, executor)
+        entries = {}
+        changed = []
+        for path, mtime_ns, size in files:
+            entry = cached.get(path)
+            if entry is not None and entry['size'] == size and (entry['mtime_ns'] == mtime_ns or not entry['dicom']):
+                entries[path] = entry
+            else:
+                changed.append((path, mtime_ns, size))
+        for entry in executor.map(lambda file: read_header(*file), changed):
+            entries[entry['path']] = entry
+    if changed or len(entries) != len(cached):
+        write_index(index_file, entries)
+    return [entries[path] for path in sorted(entries) if entries[path]['dicom']]
+
+
+def list_files(folder_name, executor):
+    """ Lists the files of a folder with os.scandir, walking each subfolder on its own thread
+
+    :param folder_name: (string) The folder that is listed
+    :param executor: (ThreadPoolExecutor) The threads for the subfolders
+    :return: files (list) A (path, mtime_ns, size) tuple per file
+    """
+    files = []
+    subfolders = []
+    with os.scandir(folder_name) as scan:
+        for entry in scan:
+            if entry.is_dir():
+                subfolders.append(entry.path)
+            elif entry.is_file() and not is_output_file(entry.name):
+                stat = entry.stat()
+                files.append((entry.path, stat.st_mtime_ns, stat.st_size))
+    for subfolder_files in executor.map(walk_files, subfolders):
+        files.extend(subfolder_files)
+    return files
+
+
+def walk_files(folder_name):
+    files = []
+    folders = [folder_name]
+    while folders:
+        with os.scandir(folders.pop()) as scan:
+            for entry in scan:
+                if entry.is_dir():
+                    folders.append(entry.path)
+                elif entry.is_file() and not is_output_file(entry.name):
+                    stat = entry.stat()
+                    files.append((entry.path, stat.st_mtime_ns, stat.st_size))
+    return files
+
+
+def is_output_file(file_name):
+    return any(fnmatch(file_name, pattern) for pattern in OUTPUT_FILES)
+
+
+def read_header(path, mtime_ns, size):
+    """ Checks the DICM magic of a file and reads the header tags of DICOM files
+
+    :param path: (string) The path of the file
+    :param mtime_ns: (int) The modification time of the file
+    :param size: (int) The size of the file
+    :return: entry (dict) The index entry of the file
+    """
+    entry = {'path': path, 'mtime_ns': mtime_ns, 'size': size, 'dicom': False}
+    with open(path, 'rb') as file:
+        preamble = file.read(132)
+    if len(preamble) < 132 or preamble[128:132] != b'DICM':
+        return entry
+    try:
+        header = dcmread(path, stop_before_pixels=True, specific_tags=list(HEADER_TAGS))
+    except Exception as error:
+        print('Skipping unreadable DICOM file {}: {}'.format(path, error))
+        return entry
+    entry['dicom'] = True
+    for tag, tag_type in HEADER_TAGS.items():
+        value = header.get(tag)
+        entry[tag] = None if value is None or value == '' else tag_type(value)
+    if entry['NumberOfFrames'] is None:
+        entry['NumberOfFrames'] = 1  # Single frame files have no NumberOfFrames
+    return entry
+
+
+def read_index(index_file):
+    if not os.path.exists(index_file):
+        return {}
+    try:
+        with open(index_file) as index:
+            return {entry['path']: entry for entry in json.load(index)}
+    except ValueError:
+        return {}  # A damaged index is rebuilt
+
+
+def write_index(index_file, entries):
+    try:
+        with open(index_file + '.tmp', 'w') as index:
+            json.dump(list(entries.values()), index)
+        os.replace(index_file + '.tmp', index_file)
+    except OSError as error:
+        print('Could not write the DICOM index {}: {}'.format(index_file, error))
@@ -0,0 +1,213 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+
+
+class LabelJournal:
+    """ Append-only storage of the labelling actions of a folder. Every action is one JSON line that is flushed and
+    synced to disk, so a crash loses at most the action being written and the folder can be resumed from the journal.
+    The frame labels are kept in memory as bitmasks over the pathology labels (bit i is pathology_labels[i]). Compaction
+    writes the frame_info / video_info CSVs and rewrites the journal as a snapshot of the current labels.
+    """
+
+    def __init__(self, journal_file, dicom_file_names, pathology_labels, compact_every=1000):
+        """
+        :param journal_file: (string) The path of the journal, the CSVs are written to the same folder
+        :param dicom_file_names: (list) The DICOM files of the folder, in video number order
+        :param pathology_labels: (list) The label names, their order defines the bitmask
+        :param compact_every: (int) The number of journal records after which the CSVs are rewritten
+        """
+        self.journal_file = journal_file
+        self.dicom_file_names = dicom_file_names
+        self.pathology_labels = pathology_labels
+        self.compact_every = compact_every
+        # Label text for every bitmask, in the format of the frame_info CSV
+        self.label_strings = np.array([', '.join(label for i, label in enumerate(pathology_labels) if mask >> i & 1)
+                                       for mask in range(1 << len(pathology_labels))], dtype=object)
+        self.output_files = None
+        self.frame_labels = {}  # video file -> bitmask per frame, in the order the videos were opened
+        self.scan_locations = {}
+        self.finished = set()
+        self.records_since_compaction = 0
+        if os.path.exists(journal_file):
+            self.replay()
+        self.journal = open(journal_file, 'a')
+
+    def replay(self):
+        """ Restores the labels from an existing journal
+
+        :return:
+        """
+        with open(self.journal_file, 'rb') as journal:
+            lines = journal.readlines()
+        valid_size = 0
+        for line_number, line in enumerate(lines):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                if line_number == len(lines) - 1:
+                    break  # A record cut off by a crash
+                raise Exception('Corrupt label journal {} at line {}'.format(self.journal_file, line_number + 1))
+            self.apply(record)
+            valid_size += len(line)
+        with open(self.journal_file, 'r+b') as journal:
+            journal.truncate(valid_size)  # Drop a cut off record, new records would otherwise be appended to it
+            if valid_size and not lines[-1].endswith(b'\n') and valid_size == sum(len(line) for line in lines):
+                journal.seek(valid_size)
+                journal.write(b'\n')
+        print('Resumed {} labelled videos from {}'.format(len(self.frame_labels), self.journal_file))
+
+    def apply(self, record):
+        op = record['op']
+        if op == 'files':
+            self.output_files = (record['frame_output_file'], record['video_output_file'])
+        elif op == 'video':
+            labels = self.frame_labels.get(record['file'])
+            if labels is None or len(labels) != record['frames']:
+                self.frame_labels[record['file']] = np.zeros(record['frames'], dtype=np.uint16)
+        elif op == 'frame':
+            self.frame_labels[record['file']][record['frame']] = record['labels']
+        elif op == 'scan':
+            self.scan_locations[record['file']] = record['location']
+        elif op == 'done':
+            self.finished.add(record['file'])
+        else:
+            raise Exception('Unknown label journal record: ' + op)
+
+    def record(self, **record):
+        """ Applies a record and appends it to the journal
+
+        :return:
+        """
+        self.record_many([record])
+
+    def record_many(self, records):
+        """ Applies records and appends them to the journal with a single sync
+
+        :param records: (list) The records, as dictionaries
+        :return:
+        """
+        if not records:
+            return
+        for record in records:
+            self.apply(record)
+        self.journal.write(''.join(json.dumps(record) + '\n' for record in records))
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.records_since_compaction += len(records)
+        if self.records_since_compaction >= self.compact_every:
+            self.compact()
+
+    def set_output_files(self, frame_output_file, video_output_file):
+        self.record(op='files', frame_output_file=frame_output_file, video_output_file=video_output_file)
+
+    def open_video(self, file, num_frames):
+        """ Registers a us sequence, keeping the labels of a sequence that was opened before
+
+        :param file: (string) The DICOM file of the us sequence
+        :param num_frames: (int) The number of frames of the us sequence
+        :return:
+        """
+        labels = self.frame_labels.get(file)
+        if labels is None or len(labels) != num_frames:
+            self.record(op='video', file=file, frames=num_frames)
+
+    def get_labels(self, file, frame):
+        """ Returns the labels of a frame
+
+        :param file: (string) The DICOM file of the us sequence
+        :param frame: (int) The frame number
+        :return: labels (list) The label names
+        """
+        mask = int(self.frame_labels[file][frame])
+        return [label for i, label in enumerate(self.pathology_labels) if mask >> i & 1]
+
+    def set_labels(self, file, frame, labels):
+        """ Stores the labels of a frame, replacing the previous ones
+
+        :param file: (string) The DICOM file of the us sequence
+        :param frame: (int) The frame number
+        :param labels: (list) The label names
+        :return: label_text (string) The labels as written to the frame_info CSV
+        """
+        return self.set_labels_many(file, [(frame, labels)])[0]
+
+    def set_labels_many(self, file, frame_labels):
+        """ Stores the labels of several frames, replacing the previous ones, with a single journal sync
+
+        :param file: (string) The DICOM file of the us sequence
+        :param frame_labels: (list) The (frame number, label names) pairs
+        :return: label_texts (list) The labels of every frame as written to the frame_info CSV
+        """
+        records = []
+        masks = []
+        for frame, labels in frame_labels:
+            mask = 0
+            for label in labels:
+                mask |= 1 << self.pathology_labels.index(label)
+            if self.frame_labels[file][frame] != mask:
+                records.append(dict(op='frame', file=file, frame=int(frame), labels=mask))
+            masks.append(mask)
+        self.record_many(records)
+        return [self.label_strings[mask] for mask in masks]
+
+    def set_scan_location(self, file, location):
+        self.record(op='scan', file=file, location=location)
+
+    def finish_video(self, file):
+        if file not in self.finished:
+            self.record(op='done', file=file)
+
+    def first_unfinished_video(self, first_video):
+        """ The video number to continue labelling from
+
+        :param first_video: (int) The video number to start from
+        :return: video_number (int) The first video from first_video on that was not finished, the last video when all are
+        """
+        for video_number in range(first_video, len(self.dicom_file_names)):
+            if self.dicom_file_names[video_number] not in self.finished:
+                return video_number
+        return len(self.dicom_file_names) - 1
+
+    def compact(self):
+        """ Writes the frame_info / video_info CSVs and replaces the journal by a snapshot of the current state. Both are
+        written to a temporary file first and then renamed, so an interrupted compaction leaves the previous files intact.
+
+        :return:
+        """
+        output_dir = os.path.dirname(self.journal_file)
+        frame_output_file, video_output_file = self.output_files
+        files = list(self.frame_labels)
+        masks = np.concatenate([self.frame_labels[file] for file in files]) if files else np.zeros(0, dtype=np.uint16)
+        frame_info = pd.DataFrame({'video file': np.repeat(np.array(files, dtype=object), [len(self.frame_labels[file]) for file in files]),
+                                   'pathology label': self.label_strings[masks]})
+        video_info = pd.DataFrame({'video file': self.dicom_file_names,
+                                   'scan location': [self.scan_locations.get(file) for file in self.dicom_file_names]})
+        self.replace_file(os.path.join(output_dir, frame_output_file), frame_info.to_csv)
+        self.replace_file(os.path.join(output_dir, video_output_file), video_info.to_csv)
+
+        records = [dict(op='files', frame_output_file=frame_output_file, video_output_file=video_output_file)]
+        for file in files:
+            records.append(dict(op='video', file=file, frames=len(self.frame_labels[file])))
+            records.extend(dict(op='frame', file=file, frame=int(frame), labels=int(self.frame_labels[file][frame]))
+                           for frame in np.flatnonzero(self.frame_labels[file]))
+        records.extend(dict(op='scan', file=file, location=location) for file, location in self.scan_locations.items())
+        records.extend(dict(op='done', file=file) for file in self.finished)
+        self.journal.close()
+        self.replace_file(self.journal_file, lambda path: self.write_records(path, records))
+        self.journal = open(self.journal_file, 'a')
+        self.records_since_compaction = 0
+
+    def write_records(self, path, records):
+        with open(path, 'w') as journal:
+            journal.writelines(json.dumps(record) + '\n' for record in records)
+
+    def replace_file(self, path, write):
+        write(path + '.tmp')
+        with open(path + '.tmp', 'a') as written:
+            os.fsync(written.fileno())
+        os.replace(path + '.tmp', path)
+
+    def close(self):
+        self.journal.close()
@@ -1,5 +1,19 @@
 from pydicom import dcmread
 from pydicom import pixel_data_handlers
+import pydicom.pixel_data_handlers.util  # not loaded by the package import on pydicom >= 3
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+from io import BytesIO
+import struct
+import threading
+import queue
+
+try:
+    from pydicom.pixels import pixel_array as decode_pixel_array  # pydicom >= 3 can decode a single frame
+    from pydicom.encaps import parse_basic_offsets, parse_fragments
+except ImportError:
+    decode_pixel_array = None
 
 def get_list_of_images_from_dicom_file(file_path):
     """ Loads all images from a DICOM file and returns them in a list. Performs image color space conversion from YBR_FULL_422 to RGB
@@ -7,9 +21,9 @@ def get_list_of_images_from_dicom_file(file_path):
     :param file_path: (string) The path of the DICOM file
     :return: list_of_images (list) A list with all the images in the DICOM file
     """
-    df = dcmread(file_path)
-    df_data = df.pixel_array
-    list_of_images = [us_image_converting(df_data[i, :, :, :]) for i in range(df_data.shape[0])]
+    df_data = decode_volume(file_path)
+    convert_ybr_to_rgb(df_data, out=df_data)  # The decoded volume is not needed anymore, so it is converted in place
+    list_of_images = list(df_data)
     # list_of_images = [df_data[i, :, :, :] for i in range(df_data.shape[0])][0:10] # Test code without image conversion and only loading subset of images
     return list_of_images
 
@@ -25,3 +39,263 @@ def us_image_converting(input_img, input_color_space='YBR_FULL_422', output_colo
     output_img = pixel_data_handlers.util.convert_color_space(input_img, input_color_space, output_color_space)
 
     return output_img
+
+def decode_volume(file_path):
+    """ Decodes all frames of a DICOM file without color space conversion
+
+    :param file_path: (string) The path of the DICOM file
+    :return: volume (nparray) The (frames, rows, columns, 3) pixel data
+    """
+    if decode_pixel_array is not None:
+        return decode_pixel_array(file_path, raw=True)  # pydicom >= 3 converts to RGB unless raw is set
+    return dcmread(file_path).pixel_array
+
+# YBR_FULL to RGB matrix as in pydicom, applied to (Y, Cb - 128, Cr - 128) row vectors
+YBR_TO_RGB = np.asarray([[1.000, 1.000, 1.000],
+                         [0.000, -0.114 * 1.772 / 0.587, 1.772],
+                         [1.402, -0.299 * 1.402 / 0.587, 0.000]], dtype=np.float32)
+YBR_OFFSET = np.asarray([0, 128, 128], dtype=np.float32)
+
+def convert_ybr_to_rgb(volume, out=None, chunk_pixels=65536):
+    """ Converts a whole (frames, rows, columns, 3) uint8 volume, or a single frame, from YBR_FULL(_422) to RGB with one
+    matrix multiply per block of pixels. Gives the same output as us_image_converting, but the float32 working buffer
+    holds one block (small enough to stay in cache) instead of float copies of every frame.
+
+    :param volume: (nparray) The uint8 input volume
+    :param out: (nparray) A preallocated C contiguous uint8 output of the same shape, may be volume itself to convert in place
+    :param chunk_pixels: (int) The number of pixels converted at once, bounding the extra memory
+    :return: out (nparray) The RGB volume
+    """
+    if out is None:
+        out = np.empty_like(volume, order='C')
+    if not out.flags.c_contiguous:
+        raise Exception('The output of the color conversion must be C contiguous')
+    pixels = volume.reshape(-1, 3)
+    out_pixels = out.reshape(-1, 3)
+    buffer = np.empty((min(chunk_pixels, pixels.shape[0]), 3), dtype=np.float32)
+    for start in range(0, pixels.shape[0], chunk_pixels):
+        chunk = buffer[:min(chunk_pixels, pixels.shape[0] - start)]
+        np.subtract(pixels[start:start + chunk.shape[0]], YBR_OFFSET, out=chunk)
+        np.matmul(chunk, YBR_TO_RGB, out=chunk)
+        chunk += 0.5  # Round(x) as floor(x + 0.5)
+        np.floor(chunk, out=chunk)
+        np.clip(chunk, 0, 255, out=chunk)
+        np.copyto(out_pixels[start:start + chunk.shape[0]], chunk, casting='unsafe')
+    return out
+
+def encapsulated_frame_offsets(pixel_data, num_frames):
+    """ Extended offset table of encapsulated pixel data holding one fragment per frame, so that a frame is found
+    without walking the fragments of the frames before it
+
+    :param pixel_data: (bytes) The encapsulated Pixel Data value
+    :param num_frames: (int) The number of frames
+    :return: (offsets, lengths) (tuple) The frame offsets from the end of the basic offset table and the frame lengths,
+    or None when the frames span several fragments
+    """
+    buffer = BytesIO(pixel_data)
+    parse_basic_offsets(buffer)
+    start = buffer.tell()
+    num_fragments, positions = parse_fragments(buffer)
+    if num_fragments != num_frames:
+        return None
+    lengths = [struct.unpack('<L', pixel_data[position + 4:position + 8])[0] for position in positions]
+    return [position - start for position in positions], lengths
+
+class LazyDicomFrames:
+    """ List-like access to the images of a DICOM file. A frame is decoded and converted from YBR_FULL_422 to RGB when it
+    is first indexed and kept in a bounded LRU cache, while the next read_ahead frames are prepared on a worker thread.
+    The file is read once: the header when the object is created and the pixel data on the first decode.
+    With pydicom < 3 single frames cannot be decoded, so this fallback is eager: the whole pixel data is decoded and
+    converted on first access.
+    """
+
+    def __init__(self, file_path, cache_size=64, read_ahead=8):
+        """
+        :param file_path: (string) The path of the DICOM file
+        :param cache_size: (int) The maximum number of converted frames kept in memory
+        :param read_ahead: (int) The number of frames after the requested one that are prepared in the background
+        """
+        self.file_path = file_path
+        self.cache_size = max(cache_size, read_ahead + 1)  # the read ahead frames must not evict the requested one
+        self.read_ahead = read_ahead
+        self.dataset = dcmread(file_path, defer_size='1 KB')  # the pixel data is read when first decoded
+        self.num_frames = int(self.dataset.get('NumberOfFrames', 1))
+        self.pixel_options = None
+        self.cache = OrderedDict()
+        self.pending = {}
+        self.volume = None
+        self.closed = False
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def __len__(self):
+        return self.num_frames
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.num_frames
+        if not 0 <= index < self.num_frames:
+            raise IndexError('Frame index out of range')
+        with self.lock:
+            frame = self.cache.get(index)
+            if frame is not None:
+                self.cache.move_to_end(index)
+            future = self.pending.get(index)
+        if frame is None and future is not None:
+            try:
+                frame = future.result()
+            except CancelledError:  # Read ahead cancelled by close
+                frame = None
+        if frame is None:
+            frame = self.load_frame(index)
+        self.schedule_read_ahead(index)
+        return frame
+
+    def schedule_read_ahead(self, index):
+        """ Queue the frames following index that are neither cached nor already queued
+
+        :param index: (int) The frame that was just requested
+        :return:
+        """
+        with self.lock:
+            if self.closed:
+                return  # Frames can still be read after close, without read ahead
+            for i in range(index + 1, min(index + 1 + self.read_ahead, self.num_frames)):
+                if i not in self.cache and i not in self.pending:
+                    self.pending[i] = self.executor.submit(self.load_frame, i)
+
+    def load_frame(self, index):
+        """ Decode and convert a frame and store it in the cache
+
+        :param index: (int) The frame index
+        :return: frame (nparray) The RGB frame
+        """
+        frame = self.decode_frame(index)
+        with self.lock:
+            self.cache[index] = frame
+            self.cache.move_to_end(index)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+            self.pending.pop(index, None)
+        return frame
+
+    def decode_options(self):
+        """ Read the pixel data and, for compressed data, locate the frames once for all the decodes
+
+        :return: options (dict) The keyword arguments of the frame decoder
+        """
+        with self.lock:
+            if self.pixel_options is None:
+                options = {}
+                pixel_data = self.dataset.PixelData
+                if self.dataset.file_meta.TransferSyntaxUID.is_encapsulated and self.num_frames > 1:
+                    offsets = encapsulated_frame_offsets(pixel_data, self.num_frames)
+                    if offsets is not None:
+                        options['extended_offsets'] = offsets
+                self.pixel_options = options
+            return self.pixel_options
+
+    def decode_frame(self, index):
+        if decode_pixel_array is not None:
+            options = self.decode_options()
+            frame = decode_pixel_array(self.dataset, index=index, raw=True, **options)  # raw keeps the YBR color space
+            frame = np.ascontiguousarray(frame)  # e.g. RLE frames are decoded plane by plane
+            return convert_ybr_to_rgb(frame, out=frame)
+        with self.lock:
+            if self.volume is None:
+                volume = self.dataset.pixel_array
+                self.volume = convert_ybr_to_rgb(volume, out=volume)
+            volume = self.volume
+        return volume[index] if self.num_frames > 1 else volume
+
+    def close(self):
+        """ Stop preparing frames, e.g. when the annotator moves to another video
+
+        :return:
+        """
+        with self.lock:
+            self.closed = True
+            for future in self.pending.values():
+                future.cancel()
+            self.pending.clear()
+        self.executor.shutdown(wait=False)
+
+
+class SequencePrefetcher:
+    """ Opens the next us sequence on a worker thread while the current one is labelled and hands the LazyDicomFrames
+    over through a queue. Only one sequence is loaded at a time: requesting another one cancels the pending load.
+    """
+
+    def __init__(self, file_names, warm_frames=8):
+        """
+        :param file_names: (list) The DICOM files of the us sequences
+        :param warm_frames: (int) The number of frames decoded before a sequence is handed over
+        """
+        self.file_names = file_names
+        self.warm_frames = warm_frames
+        self.results = queue.Queue()
+        self.index = None
+        self.cancelled = threading.Event()
+
+    def prefetch(self, index):
+        """ Start loading us sequence index, cancelling the sequence that is being loaded
+
+        :param index: (int) The index of the us sequence in file_names
+        :return:
+        """
+        self.cancel()
+        if 0 <= index < len(self.file_names):
+            self.index = index
+            self.cancelled = threading.Event()
+            threading.Thread(target=self.load, args=(index, self.cancelled), daemon=True).start()
+
+    def load(self, index, cancelled):
+        try:
+            frames = LazyDicomFrames(self.file_names[index])
+            for i in range(min(self.warm_frames, len(frames))):
+                if cancelled.is_set():
+                    break
+                frames[i]
+        except Exception as error:  # Handed over and raised on the main thread by take
+            frames = error
+        if cancelled.is_set():
+            self.discard(frames)
+        else:
+            self.results.put((index, frames))
+
+    def take(self, index):
+        """ Returns the frames of us sequence index without blocking
+
+        :param index: (int) The index of the us sequence in file_names
+        :return: frames (LazyDicomFrames) The frames, or None while the sequence is still loading
+        """
+        if self.index != index:
+            self.prefetch(index)
+        while True:
+            try:
+                loaded_index, frames = self.results.get_nowait()
+            except queue.Empty:
+                return None
+            if loaded_index == index:
+                self.index = None
+                if isinstance(frames, Exception):
+                    raise frames
+                return frames
+            self.discard(frames)  # A sequence that finished loading just before it was cancelled
+
+    def cancel(self):
+        """ Cancel the pending load and drop sequences that were loaded but not taken
+
+        :return:
+        """
+        self.cancelled.set()
+        self.index = None
+        while True:
+            try:
+                self.discard(self.results.get_nowait()[1])
+            except queue.Empty:
+                break
+
+    def discard(self, frames):
+        if isinstance(frames, LazyDicomFrames):
+            frames.close()
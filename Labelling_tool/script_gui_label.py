@@ -1,7 +1,16 @@
+import sys
+import json
 import tkinter
 from class_label_gui import LabelGUI
 from tkinter import filedialog
 
+# Optional model-assisted labelling: python script_gui_label.py <TorchScript frame model> <JSON with the labels suggested per predicted class>
+assist_model = sys.argv[1] if len(sys.argv) > 1 else None
+assist_labels = None
+if len(sys.argv) > 2:
+    with open(sys.argv[2]) as assist_labels_file:
+        assist_labels = json.load(assist_labels_file)
+
 # Pop up dialog for selecting a folder
 root = tkinter.Tk()
 root.withdraw()  # Do not show the root tkinter dialog
@@ -11,5 +20,5 @@ root.destroy()
 # Start the GUI
 gui_window = tkinter.Tk()
 gui_window.configure(background='white')
-LabelGUI(master=gui_window, first_video=0, dicom_data_path=directory)
+LabelGUI(master=gui_window, first_video=0, dicom_data_path=directory, assist_model=assist_model, assist_labels=assist_labels)
 gui_window.mainloop()
@@ -0,0 +1,178 @@
+from utils.arguments import parse_scoring_arguments
+from utils.dataset import COVID19Dataset
+from utils.tranforms import get_transforms
+from utils.dedup import subsample_frames, video_frames
+import torch
+import torch.nn.functional as F
+import torch.backends.cudnn as cudnn
+
+import numpy as np
+import pandas as pd
+import os
+import time
+import colorama
+from colorama import Fore, Style
+colorama.init()
+
+from models.network import CNNConStn
+
+
+def interleaved_order(n):
+    '''
+    Coarse to fine frame order: frame indices sorted by their bit reversal (0, n/2, n/4, 3n/4, ...), so that any
+    prefix of the order is spread over the whole video
+    '''
+    bits = max((n - 1).bit_length(), 1)
+    keys = [int(format(i, '0{}b'.format(bits))[::-1], 2) for i in range(n)]
+    return np.argsort(keys, kind='stable')
+
+
+class MeanAggregate:
+    # running mean of the frame softmax scores, the aggregate of util.argmax_mean
+
+    def __init__(self, nclasses):
+        self.total = torch.zeros(nclasses)
+        self.count = 0
+
+    def update(self, scores):
+        self.total += scores.sum(0)
+        self.count += scores.shape[0]
+        return self.total / self.count
+
+
+class UninormAggregate:
+    # running uninorm with the aggregator exported by video-score-predictor/export.py: the frames are pushed in
+    # order on the stack of completed subtrees of the training brackets, so every frame is aggregated once and the
+    # aggregate of the whole video is the video prediction of the aggregator
+
+    def __init__(self, aggregator, num_frames):
+        self.aggregator = aggregator
+        self.num_frames = num_frames
+        self.neutral = aggregator.stream_neutral(num_frames)
+        self.stack = []
+        self.seen = 0
+
+    def update(self, scores):
+        self.stack = self.aggregator.stream_update(self.stack, self.seen, scores.t(), self.neutral, self.num_frames)
+        self.seen += scores.shape[0]
+        return self.aggregator.stream_score(self.stack, self.neutral)
+
+
+def should_exit(args, history):
+    '''
+    Early exit criterion on the (frames, prediction, confidence) history of a video after each batch: at least
+    args.min_frames scored, the prediction unchanged over the last args.patience batches and a confidence of at
+    least args.confidence
+    '''
+    frames, prediction, confidence = history[-1]
+    if frames < args.min_frames or len(history) <= args.patience:
+        return False
+    stable = all(past_prediction == prediction for _, past_prediction, _ in history[-args.patience - 1:])
+    return stable and confidence >= args.confidence
+
+
+def score_video(args, model, video_data, aggregate):
+    '''
+    Feeds the frames of a video to the model batch by batch, keeping a running video aggregate, until the early
+    exit criterion holds (or to the end of the video to compare the early prediction with the full one)
+    :return: dictionary with the number of frames and the elapsed time and prediction at the exit and at the end
+    '''
+    if args.frame_order == 'interleaved':
+        video_data = video_data.iloc[interleaved_order(len(video_data))]
+    loader = torch.utils.data.DataLoader(
+        COVID19Dataset(args, video_data, get_transforms(args, 'test')),
+        batch_size=args.batch_size,
+        shuffle=False,
+        num_workers=args.num_workers,
+        drop_last=False)
+
+    result = {'frames': len(video_data), 'exit_frames': None}
+    history = []
+    start = time.perf_counter()
+    with torch.no_grad():
+        for data, _ in loader:
+            output, _ = model(data.cuda())
+            scores = F.softmax(output[:data.shape[0]], dim=1).cpu()
+            video_scores = aggregate.update(scores)
+            confidence = (video_scores / video_scores.sum()).max().item()
+            history.append((history[-1][0] + data.shape[0] if history else data.shape[0],
+                            torch.argmax(video_scores).item(), confidence))
+            if result['exit_frames'] is None and should_exit(args, history):
+                torch.cuda.synchronize()
+                result.update(exit_frames=history[-1][0], exit_time=time.perf_counter() - start,
+                              exit_prediction=history[-1][1])
+                if args.no_full_pass:
+                    return result
+    torch.cuda.synchronize()
+    result.update(full_time=time.perf_counter() - start, full_prediction=history[-1][1])
+    if result['exit_frames'] is None:
+        # the criterion never held: the whole video was needed
+        result.update(exit_frames=history[-1][0], exit_time=result['full_time'], exit_prediction=history[-1][1])
+    return result
+
+
+def report(results, full_pass):
+    frames, exit_frames = results.frames.sum(), results.exit_frames.sum()
+    print(Fore.BLUE + 'Early exit: {} videos, scored {}/{} frames ({:.2f}%)'.format(
+        len(results), exit_frames, frames, 100. * exit_frames / frames) + Style.RESET_ALL)
+    if full_pass:
+        exit_time, full_time = results.exit_time.sum(), results.full_time.sum()
+        agreement = (results.exit_prediction == results.full_prediction).mean()
+        print(Fore.BLUE + 'Latency: {:.3f}s per video at the exit, {:.3f}s for the full video ({:.2f}% saved); '
+              'agreement with the full video predictions: {:.2f}%'.format(
+              exit_time / len(results), full_time / len(results), 100. * (1 - exit_time / full_time),
+              100. * agreement) + Style.RESET_ALL)
+        for prediction, group in results.groupby('full_prediction'):
+            print('Full prediction {}: {} videos, {:.2f}% of the frames, agreement {:.2f}%'.format(
+                prediction, len(group), 100. * group.exit_frames.sum() / group.frames.sum(),
+                100. * (group.exit_prediction == group.full_prediction).mean()))
+    else:
+        print(Fore.BLUE + 'Latency: {:.3f}s per video'.format(results.exit_time.mean()) + Style.RESET_ALL)
+
+
+def score_videos(args):
+    # test videos of the patient split, as in train.py
+    data = pd.read_pickle(os.path.join(args.dataset_root, 'dataset.pkl'))
+    data = data[data.sensor.str.contains('|'.join(args.sensors))]
+    splits = pd.read_csv(os.path.join(args.dataset_root, 'train_test_split.csv'))
+    test_patients = splits[splits.split.str.contains('test')].patient_hash.tolist()
+    test_data = data[data.patient_hash.str.contains('|'.join(test_patients))]
+    test_data, _ = subsample_frames(args, test_data, args.test_subsample, 'Test')
+
+    model = CNNConStn(args.img_size, args.nclasses, args.fixed_scale)
+    model.load_state_dict(torch.load(args.model_path))
+    model = model.cuda()
+    model.eval()
+    if args.aggregation == 'uninorm':
+        if args.aggregator is None:
+            raise Exception('The uninorm aggregation needs an --aggregator')
+        aggregator = torch.jit.load(args.aggregator, map_location='cpu')
+        aggregator.eval()
+        if args.frame_order == 'interleaved' and not aggregator.associative():
+            # the brackets follow the time order: out of order frames only give the same aggregate when the
+            # uninorm is associative
+            raise Exception('The mean off-diagonal aggregation needs --frame_order sequential')
+
+    videos, frames = video_frames(test_data)
+    results = []
+    for video in videos.unique():
+        video_data = test_data[(videos == video).to_numpy()]
+        video_data = video_data.iloc[np.argsort(frames[(videos == video).to_numpy()].to_numpy(), kind='stable')]
+        aggregate = MeanAggregate(args.nclasses) if args.aggregation == 'mean' else UninormAggregate(aggregator, len(video_data))
+        result = score_video(args, model, video_data, aggregate)
+        result['video'] = video
+        print('{}: exit after {}/{} frames, prediction {}'.format(
+            video, result['exit_frames'], result['frames'], result['exit_prediction']))
+        results.append(result)
+    results = pd.DataFrame(results)
+    report(results, not args.no_full_pass)
+
+    os.makedirs(os.path.join('logs', args.run_name), exist_ok=True)
+    results.to_csv(os.path.join('logs', args.run_name, 'early_exit.csv'), index=False)
+
+
+if __name__ == '__main__':
+    cudnn.benchmark = True
+    args = parse_scoring_arguments()
+    print(args)
+    score_videos(args)
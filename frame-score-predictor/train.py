@@ -1,6 +1,7 @@
 from utils.arguments import parse_arguments
 from utils.dataset import COVID19Dataset
 from utils.tranforms import get_transforms
+from utils.dedup import subsample_frames
 import torch.optim as optim
 import torch
 import torch.nn as nn
@@ -151,7 +152,7 @@ def train(args, model, train_loader, nclasses, optimizer, epoch, fixed_samples,
 
     return model
 
-def test(args, model, test_loader, nclasses, epoch, state_dict, weights_path, fixed_samples):
+def test(args, model, test_loader, nclasses, epoch, state_dict, weights_path, fixed_samples, expansion=None):
     model.eval()
     test_losses = []
     correct = 0
@@ -171,17 +172,24 @@ def test(args, model, test_loader, nclasses, epoch, state_dict, weights_path, fi
             # compute metrics
             preds.append(pred.view(-1).cpu())
             labels.append(target.view(-1).cpu())
-
-            for t, p in zip(target.view(-1), pred.view(-1)):
-                confusion_matrix[t.long(), p.long()] += 1
     test_loss = np.mean(np.asarray(test_losses))
 
+    preds, labels = torch.cat(preds), torch.cat(labels)
+    if expansion is not None:
+        # subsampled test set: every frame gets the prediction of the representative of its group
+        representatives, labels = expansion
+        preds = preds[representatives]
+        correct = preds.eq(labels).sum().item()
+        print('Scored {}/{} test frames'.format(len(test_loader.dataset), len(labels)))
+    for t, p in zip(labels, preds):
+        confusion_matrix[t.long(), p.long()] += 1
+
     precision, recall, fscore, _ = precision_recall_fscore_support(
-        y_true=torch.cat(labels), y_pred=torch.cat(preds), average='micro')
+        y_true=labels, y_pred=preds, average='micro')
     per_class_accuracy = confusion_matrix.diag() / confusion_matrix.sum(1)
     print(Fore.RED + '\nTest Set: Average Loss: {:.4f}, Accuracy: {}/{} \
-    ({:.2f}%)'.format(test_loss, correct, len(test_loader.dataset), 100 *
-    correct / len(test_loader.dataset))  + Style.RESET_ALL)
+    ({:.2f}%)'.format(test_loss, correct, len(labels), 100 *
+    correct / len(labels))  + Style.RESET_ALL)
 
     print(Fore.RED + 'Classwise Accuracy:: Cl-0: {}/{}({:.2f}%), Cl-1: {}/{}({:.2f}%) \
     Cl-2: {}/{}({:.2f}%), Cl-3: {}/{}({:.2f}%); \
@@ -192,7 +200,7 @@ def test(args, model, test_loader, nclasses, epoch, state_dict, weights_path, fi
     int(confusion_matrix.diag()[3].item()), int(confusion_matrix.sum(1)[3].item()), per_class_accuracy[3].item() * 100.,
     precision, recall, fscore) + Style.RESET_ALL)
 
-    metrics = {'test/accuracy': correct / len(test_loader.dataset) * 100.,
+    metrics = {'test/accuracy': correct / len(labels) * 100.,
               'test/precision': precision,
               'test/recall': recall,
               'test/F1': fscore,
@@ -263,6 +271,15 @@ def experiment(args):
     train_data = data[data.patient_hash.str.contains('|'.join(train_patients))]
     test_data = data[data.patient_hash.str.contains('|'.join(test_patients))]
 
+    # drop near-duplicate frames; the test metrics are always computed on every test frame
+    train_data, _ = subsample_frames(args, train_data, args.train_subsample, 'Train')
+    full_test_data = test_data
+    test_data, test_expand = subsample_frames(args, test_data, args.test_subsample, 'Test')
+    test_expansion = None
+    if args.test_subsample != 'none':
+        test_expansion = (torch.from_numpy(test_expand),
+                          torch.tensor([sum(l) for l in full_test_data.label.tolist()], dtype=torch.long))
+
     # subset the dataset
     train_dataset = COVID19Dataset(args, train_data, get_transforms(args, 'train'))
     test_dataset = COVID19Dataset(args, test_data, get_transforms(args, 'test'))
@@ -317,7 +334,7 @@ def experiment(args):
         model = train(args, model, train_loader, len(list(set(train_labels))), optimizer, epoch,
                       fixed_samples_train, fixed_y_train)
         test(args, model, test_loader, len(list(set(train_labels))), epoch, state_dict, args.weights_dir,
-             fixed_samples_test)
+             fixed_samples_test, test_expansion)
         exp_lr_scheduler.step()
 
 
@@ -2,7 +2,7 @@ import argparse
 from datetime import datetime
 
 
-def parse_arguments():
+def get_parser():
 
     parser = argparse.ArgumentParser(description='Configurations.')
     parser.add_argument(
@@ -90,7 +90,92 @@ def parse_arguments():
         default=2,
         type=int,
         help='multiplier for sord loss')
+    parser.add_argument(
+        '--train_subsample',
+        default='none',
+        choices=['none', 'cluster', 'stride'],
+        help='Keep one training frame per group of near-duplicates (cluster) or every subsample_stride frames (stride).')
+    parser.add_argument(
+        '--test_subsample',
+        default='none',
+        choices=['none', 'cluster', 'stride'],
+        help='Score only one test frame per group and give its prediction to the whole group.')
+    parser.add_argument(
+        '--subsample_stride',
+        default=4,
+        type=int,
+        help='Frame stride for the stride subsampling.')
+    parser.add_argument(
+        '--dedup_distance',
+        default=16,
+        type=int,
+        help='Maximum number of differing signature bits for two frames to be near-duplicates.')
+    parser.add_argument(
+        '--signature_size',
+        default=16,
+        type=int,
+        help='Side of the difference hash of a frame (signature_size ** 2 bits).')
+    return parser
+
+
+def parse_arguments():
+
+    parser = get_parser()
+    args = parser.parse_args()
+    args.run_name = '-'.join([args.model_name, args.comment])
+
+    return args
+
+
+def parse_scoring_arguments():
+
+    parser = get_parser()
+    parser.add_argument(
+        '--model_path',
+        required=True,
+        type=str,
+        help='Weights of the trained model (e.g. logs/<run_name>/weights/best_model.pth).')
+    parser.add_argument(
+        '--nclasses',
+        default=4,
+        type=int,
+        help='Number of scores predicted by the model.')
+    parser.add_argument(
+        '--aggregation',
+        default='mean',
+        choices=['mean', 'uninorm'],
+        help='Running video aggregate: mean softmax or a TorchScript uninorm aggregator.')
+    parser.add_argument(
+        '--aggregator',
+        default=None,
+        type=str,
+        help='TorchScript aggregator saved by video-score-predictor/export.py, for the uninorm aggregation.')
+    parser.add_argument(
+        '--frame_order',
+        default='interleaved',
+        choices=['sequential', 'interleaved'],
+        help='Order in which the frames of a video are scored: in time or coarse to fine over the whole video.')
+    parser.add_argument(
+        '--min_frames',
+        default=16,
+        type=int,
+        help='Number of frames scored before a video can exit early.')
+    parser.add_argument(
+        '--patience',
+        default=2,
+        type=int,
+        help='Number of consecutive batches the video prediction has to stay unchanged to exit early.')
+    parser.add_argument(
+        '--confidence',
+        default=0.,
+        type=float,
+        help='Minimum share of the top score in the normalized video aggregate to exit early.')
+    parser.add_argument(
+        '--no_full_pass',
+        default=False,
+        action='store_true',
+        help='Stop scoring a video at the early exit instead of scoring all of it to measure the agreement.')
     args = parser.parse_args()
     args.run_name = '-'.join([args.model_name, args.comment])
 
-    return args
\ No newline at end of file
+    return args
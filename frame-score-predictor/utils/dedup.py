@@ -0,0 +1,129 @@
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+
+def frame_signature(frame, size=16):
+    '''
+    Difference hash of a frame: the grayscale frame is block averaged to size x (size + 1) and every bit tells
+    whether a pixel is brighter than its right neighbour
+    :param frame: (H, W) or (H, W, C) numpy frame
+    :return: packed uint8 array of size * size bits
+    '''
+    gray = frame.mean(axis=2) if frame.ndim == 3 else frame
+    gray = gray.astype(np.float32)
+    rows = np.linspace(0, gray.shape[0], size + 1).astype(int)[:-1]
+    cols = np.linspace(0, gray.shape[1], size + 2).astype(int)[:-1]
+    sums = np.add.reduceat(np.add.reduceat(gray, rows, axis=0), cols, axis=1)
+    counts = np.outer(np.diff(np.append(rows, gray.shape[0])), np.diff(np.append(cols, gray.shape[1])))
+    small = sums / counts
+    return np.packbits(small[:, 1:] > small[:, :-1])
+
+
+def hamming_distance(a, b):
+    return int(np.unpackbits(np.bitwise_xor(a, b)).sum())
+
+
+def compute_signatures(dataset_root, filenames, size=16):
+    '''
+    Signatures of the frames in dataset_root/frames, cached in dataset_root/frame_signatures_<size>.pkl so that
+    only frames missing from the cache are loaded
+    :return: dict mapping filename to signature
+    '''
+    cache_file = os.path.join(dataset_root, 'frame_signatures_%d.pkl' % size)
+    signatures = {}
+    if os.path.exists(cache_file):
+        with open(cache_file, 'rb') as f:
+            signatures = pickle.load(f)
+    missing = [filename for filename in filenames if filename not in signatures]
+    for filename in tqdm(missing, desc='Frame signatures'):
+        signatures[filename] = frame_signature(np.load(os.path.join(dataset_root, 'frames', filename)), size)
+    if missing:
+        with open(cache_file + '.tmp', 'wb') as f:
+            pickle.dump(signatures, f)
+        os.replace(cache_file + '.tmp', cache_file)
+    return signatures
+
+
+def video_frames(data):
+    '''
+    Video and frame number of every row: the video/frame columns written by Labelling_tool/build_dataset.py when
+    present, otherwise the filename without and with its trailing frame number
+    '''
+    if 'video' in data.columns and 'frame' in data.columns:
+        return data.video.astype(str), data.frame.astype(int)
+    parts = data.filename.str.extract(r'^(.*?)[_-]?(\d+)\.npy$')
+    videos = parts[0].fillna(data.filename)
+    frames = pd.to_numeric(parts[1], errors='coerce').fillna(0).astype(int)
+    return videos, frames
+
+
+def cluster_frames(data, signatures, max_distance):
+    '''
+    Groups consecutive near-duplicate frames of each video: a frame joins the current cluster while its signature
+    is within max_distance bits of the first frame of the cluster
+    :return: (clusters, representatives) cluster id of every row and the row position of its first frame
+    '''
+    videos, frames = video_frames(data)
+    order = np.lexsort((frames.to_numpy(), videos.to_numpy()))
+    clusters = np.zeros(len(data), dtype=int)
+    representatives = np.zeros(len(data), dtype=int)
+    cluster, previous_video, first = -1, None, None
+    for position in order:
+        video = videos.iloc[position]
+        signature = signatures[data.filename.iloc[position]]
+        if video != previous_video or hamming_distance(signature, first) > max_distance:
+            cluster += 1
+            previous_video, first, start = video, signature, position
+        clusters[position] = cluster
+        representatives[position] = start
+    return clusters, representatives
+
+
+def stride_frames(data, stride):
+    '''
+    Groups every stride consecutive frames of each video
+    :return: (clusters, representatives) as in cluster_frames
+    '''
+    videos, frames = video_frames(data)
+    order = np.lexsort((frames.to_numpy(), videos.to_numpy()))
+    rank = pd.Series(videos.to_numpy()[order]).groupby(videos.to_numpy()[order]).cumcount().to_numpy()
+    starts = np.flatnonzero(rank % stride == 0)
+    clusters = np.zeros(len(data), dtype=int)
+    representatives = np.zeros(len(data), dtype=int)
+    clusters[order] = np.cumsum(rank % stride == 0) - 1
+    representatives[order] = order[starts][clusters[order]]
+    return clusters, representatives
+
+
+def subsample_frames(args, data, policy, name):
+    '''
+    Keeps one frame per group of near-duplicates ('cluster') or one every args.subsample_stride frames ('stride')
+    of each video and prints how much data was dropped
+    :param policy: 'none', 'cluster' or 'stride'
+    :return: (subset, expand) the kept rows and, for every row of data, the position of its representative in subset
+    '''
+    if policy == 'none':
+        return data, np.arange(len(data))
+    elif policy == 'cluster':
+        signatures = compute_signatures(args.dataset_root, data.filename.tolist(), args.signature_size)
+        clusters, representatives = cluster_frames(data, signatures, args.dedup_distance)
+    elif policy == 'stride':
+        clusters, representatives = stride_frames(data, args.subsample_stride)
+    else:
+        raise Exception('Unknown subsampling policy ' + policy)
+    kept = np.unique(representatives)
+    expand = np.searchsorted(kept, representatives)
+    subset = data.iloc[kept]
+
+    labels = pd.Series([sum(l) for l in data.label.tolist()])
+    kept_labels = labels.iloc[kept].value_counts().reindex(labels.unique(), fill_value=0)
+    print('{} frames subsampling ({}): kept {}/{} frames ({:.2f}% dropped), {} videos, {:.1f} frames per group'.format(
+        name, policy, len(kept), len(data), 100. * (1 - len(kept) / max(len(data), 1)),
+        video_frames(data)[0].nunique(), len(data) / max(len(kept), 1)))
+    print('Frames per label (kept/all): ' + ', '.join(['{}: {}/{}'.format(label, kept_labels[label], count)
+                                                       for label, count in labels.value_counts().sort_index().items()]))
+    return subset, expand
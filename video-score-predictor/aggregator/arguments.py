@@ -0,0 +1,48 @@
+import argparse
+
+def get_parser(sweep=False):
+	# In sweep mode the compared settings take a list of values, one configuration is trained per combination
+	def swept(default):
+		return [default] if sweep else default
+	nargs = '+' if sweep else None
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument("datafile")
+	parser.add_argument("labelfile")
+	parser.add_argument("mapfile")
+	parser.add_argument("outputdir")
+	parser.add_argument("--testfile", default=None)
+	parser.add_argument("--expname", default="trial")
+	parser.add_argument("--tnorm", default=swept("product"), choices=['lukasiewicz', 'product'], nargs=nargs)
+	parser.add_argument("--off_diagonal", default=swept("min"), choices=['min', 'mean', 'max'], nargs=nargs)
+	parser.add_argument("--loss", default=swept("ce"), choices=['ce', 'kl'], nargs=nargs)
+	parser.add_argument("--earlystop", default="last", choices=['last', 'train_loss', 'train_acc'])
+	parser.add_argument('--setting', default='traintest', choices=['traintest', 'lopo', 'lovo', 'kfolds'])
+	parser.add_argument("--epochs", default=20, type=int)
+	parser.add_argument("--lr", default=0.01, type=float)
+	parser.add_argument("--normalize_neutral", action='store_true', default=False)
+	parser.add_argument("--use_majority_label", action='store_true', default=False)
+	parser.add_argument("--label_cache", default=None, help="Directory caching the label table between runs (no caching if unset)")
+	parser.add_argument("--use_binary_labels", action='store_true', default=False)
+	parser.add_argument("--use_score_hierarchy", action='store_true', default=False)
+	parser.add_argument("--rebalance_scores", action='store_true', default=False)
+	if sweep:
+		parser.add_argument("--use_sord", default=[0], type=int, choices=[0, 1], nargs=nargs)
+	else:
+		parser.add_argument("--use_sord", action='store_true', default=False)
+	parser.add_argument("--multithread", action='store_true', default=False)
+	parser.add_argument("--stratified", action='store_true', default=False)
+	parser.add_argument("--zero_score_gap", default=swept(0.5), type=float, nargs=nargs)
+	parser.add_argument("--init_neutral", default=0., type=float)
+	parser.add_argument("--lr_gamma", default=1/3, type=float)
+	parser.add_argument("--numfolds", default=5, type=int)
+	parser.add_argument("--optimizer", default="adam", choices=['adam', 'lbfgs', 'search'], help="lbfgs runs one full-batch L-BFGS iteration with line search per epoch")
+	parser.add_argument("--search", default="coordinate", choices=['coordinate', 'grid'], help="Neutral search strategy for --optimizer search: coordinate descent over one neutral element at a time, or the exhaustive grid of grid_size**scores combinations (~6.8M for the default grid and 4 scores)")
+	parser.add_argument("--grid_size", default=51, type=int, help="Number of neutral values evaluated in [0,1] by the search, the grid search evaluates grid_size**scores combinations")
+	parser.add_argument("--search_chunk", default=4096, type=int, help="Number of neutral combinations evaluated at once by the grid search")
+	parser.add_argument("--refine_epochs", default=0, type=int, help="Gradient epochs run after the search")
+	parser.add_argument("--warm_start", action='store_true', default=False, help="Fit once on all data and start every lopo/lovo/kfolds fold from the fitted parameters")
+	parser.add_argument("--tolerance", default=0., type=float, help="Stop training when the epoch loss changes by less than <val> (0=train for all epochs)")
+	parser.add_argument("--verbosity", default=2, type=int, choices=[0, 1, 2, 3], help="Events written to <expname>.jsonl: 0=run, 1=+folds, 2=+epochs, 3=+parameters and gradients printed to the log")
+	parser.add_argument("--activate_linear", default=0, type=int, help="Activate linear layer after <val> iterations (0=no activation)")
+	return parser
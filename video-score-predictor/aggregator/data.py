@@ -1,42 +1,150 @@
 from torch.utils.data import Dataset
 import torch.tensor
+from torch.nn.utils.rnn import pad_sequence
 import pandas as pd
 import numpy as np
 from scipy.stats import describe
+from os import path
+from aggregator.logger import text_log
 
-def majority_label(labeldir):
+def label_files(labeldir):
     from os import walk
-    from os import path
-    from functools import reduce
+    return sorted(path.join(root,filename) for root,_,filenames in walk(labeldir) for filename in filenames if 'Score' in filename)
+
+def majority_label(labeldir):
     labels4annotator = []
-    for root,_,filenames in walk(labeldir):
-        for filename in filenames:            
-            if not 'Score' in filename:
-                continue          
-            print('Processing file ', filename)  
-            labels4annotator.append(pd.read_excel(path.join(root,filename)))
-    merged_labels = reduce(lambda left,right: pd.merge(left, right, on='Video'), labels4annotator)
-    majority_labels = merged_labels.iloc[:,1:].mode(axis=1).max(axis=1)
-    majority_labels = pd.concat([merged_labels['Video'], majority_labels], axis=1)
-    majority_labels.columns = ['Video','Score']
-    return majority_labels
+    for filename in label_files(labeldir):
+        text_log.info('Processing file %s', filename)
+        labels = pd.read_excel(filename)
+        labels4annotator.append(labels.melt(id_vars='Video').assign(annotator=len(labels4annotator)))
+    # single vote over the long (video, annotator, score) table: only videos labelled by every annotator are kept
+    # and ties between modal scores are broken in favour of the highest score
+    votes = pd.concat(labels4annotator, ignore_index=True)
+    annotators = votes.groupby('Video')['annotator'].nunique()
+    votes = votes[votes['Video'].isin(annotators.index[annotators == len(labels4annotator)])]
+    counts = pd.crosstab(votes['Video'], votes['value'])
+    if counts.empty:
+        # no video labelled by every annotator
+        return pd.DataFrame({'Video' : [], 'Score' : []})
+    modes = counts.to_numpy() == counts.to_numpy().max(axis=1, keepdims=True)
+    scores = np.where(modes, counts.columns.to_numpy()[np.newaxis,:], -np.inf).max(axis=1)
+    return pd.DataFrame({'Video' : counts.index, 'Score' : scores.astype(votes['value'].dtype)})
+
+def read_labelmap(labelfile, mapfile, use_majority_label=False):
+    if use_majority_label:
+        labels = majority_label(labelfile)
+    else:
+        labels = pd.read_excel(labelfile)
+    mapping = pd.read_excel(mapfile)
+    return mapping.merge(labels,on='Video')
+
+def cached_labelmap(labelfile, mapfile, use_majority_label=False, cachedir=None):
+    """ Reads the label table from the Excel files, keeping a pickled copy in cachedir keyed by the source paths,
+    their modification times and sizes and the labelling options. Adding, removing or editing an annotator file
+    changes the key and rebuilds the table.
+    """
+    if cachedir is None:
+        return read_labelmap(labelfile, mapfile, use_majority_label)
+    from os import makedirs, replace, stat
+    from hashlib import sha1
+    sources = (label_files(labelfile) if use_majority_label else [labelfile]) + [mapfile]
+    key = repr([(path.abspath(source), stat(source).st_mtime_ns, stat(source).st_size) for source in sources] + [use_majority_label])
+    cachefile = path.join(cachedir, 'labels-%s.pkl' %sha1(key.encode()).hexdigest())
+    if path.exists(cachefile):
+        return pd.read_pickle(cachefile)
+    labelmap = read_labelmap(labelfile, mapfile, use_majority_label)
+    makedirs(cachedir, exist_ok=True)
+    labelmap.to_pickle(cachefile + '.tmp')
+    replace(cachefile + '.tmp', cachefile)
+    return labelmap
+
+def save_columnar_predictions(predfile, outdir):
+    """ Converts a pickled frame predictions DataFrame to a directory of .npy files that can be memory-mapped:
+    scores.npy holds the (frames, scores) float32 matrix, string columns are stored as <column>.codes.npy and
+    <column>.categories.npy and numeric columns as <column>.npy. Columns holding other objects are dropped.
+    """
+    from os import makedirs
+    preds = pd.read_pickle(predfile).rename(columns={'filenames' : 'filename'})
+    preds['filename'] = preds['filename'].str.replace(".mat", "", regex=False)
+    makedirs(outdir, exist_ok=True)
+    np.save(path.join(outdir, 'scores.npy'), np.array(preds['scores'].values.tolist(), dtype=np.float32))
+    for column in preds.columns.drop('scores'):
+        values = preds[column]
+        if values.dtype.kind in 'biuf':
+            np.save(path.join(outdir, column + '.npy'), values.to_numpy())
+        elif values.map(lambda v: isinstance(v, str)).all():
+            codes, categories = pd.factorize(values)
+            np.save(path.join(outdir, column + '.codes.npy'), codes.astype(np.int32))
+            np.save(path.join(outdir, column + '.categories.npy'), categories.to_numpy().astype(str))
+        else:
+            text_log.info('Skipping column %s', column)
+
+def load_columnar_predictions(preddir):
+    """ Memory-maps a directory written by save_columnar_predictions
+    :return: (scores, columns) the (frames, scores) matrix and a dictionary mapping each string column to its
+    (codes, categories) pair and each numeric column to its values
+    """
+    from os import listdir
+    scores = np.load(path.join(preddir, 'scores.npy'), mmap_mode='r')
+    columns = {}
+    for filename in sorted(listdir(preddir)):
+        if filename.endswith('.codes.npy'):
+            column = filename[:-len('.codes.npy')]
+            columns[column] = (np.load(path.join(preddir, filename), mmap_mode='r'),
+                               np.load(path.join(preddir, column + '.categories.npy')))
+        elif filename.endswith('.npy') and not filename.endswith('.categories.npy') and filename != 'scores.npy':
+            columns[filename[:-len('.npy')]] = np.load(path.join(preddir, filename), mmap_mode='r')
+    return scores, columns
+
+def join_columnar_predictions(columns, labelmap):
+    """ Inner join on filename done on the filename categories only, with the rows of pd.merge: each frame is paired
+    with every label row of its filename, in frame order then label table order. Clashing columns get the pd.merge
+    suffixes. The scores stay in their (frames, scores) matrix, each joined row holds its row as score_row.
+    """
+    codes, categories = columns['filename']
+    label_categories = pd.Index(categories).get_indexer(labelmap['filename'].to_numpy())
+    label_rows = np.argsort(label_categories, kind='stable')
+    label_rows = label_rows[label_categories[label_rows] >= 0]
+    counts = np.bincount(label_categories[label_rows], minlength=len(categories))
+    starts = np.cumsum(counts) - counts
+    matches = counts[codes]
+    frames = np.repeat(np.arange(len(codes)), matches)
+    first = np.repeat(np.cumsum(matches) - matches, matches)
+    rows = label_rows[starts[codes[frames]] + np.arange(len(frames)) - first]
+    data = labelmap.iloc[rows].reset_index(drop=True)
+    clashing = [column for column in columns if column in data.columns and column != 'filename']
+    data = data.rename(columns={column : column + '_y' for column in clashing})
+    for column, values in columns.items():
+        name = column + '_x' if column in clashing else column
+        if isinstance(values, tuple):
+            data[name] = values[1].astype(object)[values[0][frames]]
+        else:
+            data[name] = values[frames]
+    data['score_row'] = frames
+    return data
 
 class patientDataset(Dataset):
     
-    def __init__(self, predfile=None, labelfile=None, mapfile=None, data=None, use_majority_label=False, use_binary_labels=False):
+    def __init__(self, predfile=None, labelfile=None, mapfile=None, data=None, use_majority_label=False, use_binary_labels=False, label_cache=None, scores=None):
+        # the frame scores are the rows of the (frames, scores) matrix scores given by the score_row column of data
         if predfile:
-            preds = pd.read_pickle(predfile).rename(columns={'filenames' : 'filename'})
-            if use_majority_label:
-                labels = majority_label(labelfile)
+            labelmap = cached_labelmap(labelfile, mapfile, use_majority_label, label_cache)
+            if path.isdir(predfile):
+                # columnar predictions written by save_columnar_predictions, the scores stay memory-mapped
+                scores, columns = load_columnar_predictions(predfile)
+                self.data = join_columnar_predictions(columns, labelmap)
             else:
-                labels = pd.read_excel(labelfile)
-            mapping = pd.read_excel(mapfile)
-            labelmap = mapping.merge(labels,on='Video')
-            preds['filename']=preds['filename'].map(lambda s : s.replace(".mat",""))
-            #self.data = pd.merge(preds,labelmap, on=['hospital', 'patient', 'filename'])
-            self.data = pd.merge(preds,labelmap, on=['filename'])
+                preds = pd.read_pickle(predfile).rename(columns={'filenames' : 'filename'})
+                preds['filename']=preds['filename'].map(lambda s : s.replace(".mat",""))
+                #self.data = pd.merge(preds,labelmap, on=['hospital', 'patient', 'filename'])
+                self.data = pd.merge(preds,labelmap, on=['filename'])
         else:  
             self.data = data
+        if scores is None:
+            # frame scores given as a column of lists
+            scores = np.array(self.data['scores'].values.tolist(), dtype=np.float32)
+            self.data = self.data.drop(columns='scores').assign(score_row=np.arange(len(self.data)))
+        self.scores = scores
         if use_binary_labels:
             self.data['Score'] = self.data['Score'].apply(lambda x: min(x,1))
         #self.videos = self.data.groupby(['hospital','patient','filename'])
@@ -55,13 +163,23 @@ class patientDataset(Dataset):
         return list(self.videos.groups.keys())
 
     def get_input(self, index):
-        data = self.videos.get_group(index)     
-        return torch.tensor(np.array(data['scores'].values.tolist()).transpose(), dtype=torch.float32) 
+        rows = self.videos.get_group(index)['score_row'].to_numpy()
+        if len(rows) and rows[-1] - rows[0] == len(rows) - 1 and np.all(np.diff(rows) == 1):
+            scores = self.scores[rows[0]:rows[-1] + 1]  # frames stored contiguously, read as a slice
+        else:
+            scores = self.scores[rows]
+        return torch.tensor(np.asarray(scores).transpose(), dtype=torch.float32)
         
     def get_target(self, index):
         data = self.videos.get_group(index)     
         return torch.tensor([data['Score'].iloc[0]])
 
+    def get_batch(self):
+        inputs, labels = zip(*self)
+        lengths = torch.tensor([x.shape[1] for x in inputs])
+        batch = pad_sequence([x.t() for x in inputs], batch_first=True).permute(0,2,1)
+        return batch, lengths, torch.cat(labels)
+
     def get_patient_indices(self):
         return set([(hospital,patient) for (hospital,patient,filename) in self.videos.groups.keys()])
 
@@ -73,27 +191,27 @@ class patientDataset(Dataset):
 
     def get_patient(self, patient):
         patient_data = self.data.query('hospital_x == "%s" and patient_x == "%s"' %(patient[0],patient[1]))
-        return patientDataset(data=patient_data)
+        return patientDataset(data=patient_data, scores=self.scores)
 
     def exclude_patient(self, patient):
         other_patients_data = self.data.query('hospital_x != "%s" or patient_x != "%s"' %(patient[0],patient[1]))        
-        return patientDataset(data=other_patients_data)
+        return patientDataset(data=other_patients_data, scores=self.scores)
 
     def get_video(self, video):
         video_data = self.data.query('hospital_x == "%s" and patient_x == "%s" and filename == "%s"' %(video[0],video[1],video[2]))
-        return patientDataset(data=video_data)
+        return patientDataset(data=video_data, scores=self.scores)
 
     def exclude_video(self, video):
         other_videos_data = self.data.query('hospital_x != "%s" or patient_x != "%s" or filename != "%s"' %(video[0],video[1],video[2]))
-        return patientDataset(data=other_videos_data)
+        return patientDataset(data=other_videos_data, scores=self.scores)
 
     def get_score_range(self):
-        return len(self.data['scores'][0])
+        return self.scores.shape[1]
 
     def get_patients(self, patients):
         selection = pd.DataFrame(patients, columns=['hospital_x','patient_x'])
         patients_data = pd.merge(self.data, selection, on=['hospital_x','patient_x'])
-        return patientDataset(data=patients_data)
+        return patientDataset(data=patients_data, scores=self.scores)
 
     def get_target_stats(self):
         return self.videos.head(1)['Score'].value_counts(sort=False)  
@@ -107,27 +225,30 @@ class patientDataset(Dataset):
                 i+=1
         return splits
 
+    def get_patient_histograms(self, score_range):
+        # patients x scores matrix of video label counts, indexed by (hospital, patient)
+        videos = self.videos.head(1)
+        histograms = pd.crosstab([videos['hospital_x'], videos['patient_x']], videos['Score'])
+        return histograms.reindex(columns=range(score_range), fill_value=0).sort_index()
+
     def get_stratified_kfold_splits(self, k, score_range):
         splits = [set() for i in range(k)] 
-        splits_stats = pd.DataFrame(data=np.zeros((score_range,k)), index=range(score_range), columns=range(k))
-        hospitals = list(self.get_hospitals())
-        hospitals.sort()
-        for hospital in hospitals:
-            hospital_patients = list(self.get_hospital_patients(hospital))
-            hospital_patients.sort()
-            for patient in hospital_patients:
-                patient_stats = self.get_patient(patient).get_target_stats()
-                split = splits_stats.sub(patient_stats, axis=0).sum(axis=0).argmin()
-                splits[split].add(patient)
-                splits_stats[split] = splits_stats[split].add(patient_stats, axis=0, fill_value=0)
-        print("Splits label distribution")
-        print(splits_stats)
+        splits_stats = np.zeros((score_range,k))
+        histograms = self.get_patient_histograms(score_range)
+        # greedy assignment in (hospital, patient) order: each patient goes to the split with the fewest videos
+        # having the scores of the patient's videos, the first such split on ties
+        for patient, patient_stats in zip(histograms.index, histograms.to_numpy()):
+            split = np.argmin(splits_stats[patient_stats > 0].sum(axis=0))
+            splits[split].add(patient)
+            splits_stats[:,split] += patient_stats
+        text_log.info("Splits label distribution")
+        text_log.info("%s", pd.DataFrame(data=splits_stats, index=range(score_range), columns=range(k)))
         return splits
 
     def print_stats(self):
-        data = np.array(self.data['scores'].values.tolist())
-        print(describe(data))
-        print(describe(data.max(1)))
+        data = np.asarray(self.scores[self.data['score_row'].to_numpy()])
+        text_log.info("%s", describe(data))
+        text_log.info("%s", describe(data.max(1)))
 
     def compute_score_weights(self):
         counts = self.videos.head(1)['Score'].value_counts(sort=False).to_numpy(dtype=float)
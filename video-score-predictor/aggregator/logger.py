@@ -0,0 +1,63 @@
+import json
+import time
+import logging
+from threading import Lock
+
+# verbosity levels of the events, a logger at a given verbosity writes the events up to that level
+RUN = 0
+FOLD = 1
+EPOCH = 2
+DEBUG = 3
+
+class EventLogger:
+	"""Writes one JSON record per line, with the event name and the seconds elapsed since the logger was opened.
+	Nothing is written until open() is called. Thread safe, so that multithreaded folds can share it.
+	"""
+
+	def __init__(self):
+		self.file = None
+		self.verbosity = EPOCH
+		self.start = time.perf_counter()
+		self.lock = Lock()
+
+	def open(self, logfile, verbosity=EPOCH):
+		self.file = open(logfile, 'w')
+		self.verbosity = verbosity
+		self.start = time.perf_counter()
+
+	def close(self):
+		if self.file is not None:
+			self.file.close()
+			self.file = None
+
+	def enabled(self, level):
+		return level <= self.verbosity
+
+	def log(self, event, level=RUN, **fields):
+		if self.file is None or not self.enabled(level):
+			return
+		record = {'event' : event, 'time' : time.perf_counter() - self.start}
+		record.update(fields)
+		with self.lock:
+			self.file.write(json.dumps(record, default=float) + '\n')
+			self.file.flush()
+
+logger = EventLogger()
+
+def parameter_values(net):
+	return {name : p.detach().tolist() for name, p in net.named_parameters()}
+
+# human readable messages of the aggregator package, on the console unless redirected with open_text_log
+text_log = logging.getLogger('aggregator')
+text_log.setLevel(logging.INFO)
+text_log.propagate = False
+console = logging.StreamHandler()
+console.setFormatter(logging.Formatter('%(message)s'))
+text_log.addHandler(console)
+
+def open_text_log(logfile):
+	# the messages of a run go to logfile instead of the console
+	handler = logging.FileHandler(logfile, 'w')
+	handler.setFormatter(logging.Formatter('%(message)s'))
+	text_log.removeHandler(console)
+	text_log.addHandler(handler)
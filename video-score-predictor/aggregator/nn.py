@@ -3,11 +3,14 @@ import torch
 import pandas as pd
 import numpy as np
 import torch.nn.functional as F
+from typing import List
+from aggregator.logger import text_log
 
 class Ensemble(nn.Module):
 
     def __init__(self, mode='mean'):
-        self.predictors = []
+        super(Ensemble, self).__init__()
+        self.predictors = nn.ModuleList()
         if mode == 'min':
             self.aggregation = min_aggregation
         elif mode == 'mean':
@@ -18,7 +21,24 @@ class Ensemble(nn.Module):
             raise Exception('Unknown aggregation mode: ' + mode) 
 
     def forward(self, x):
-        return self.aggregation(torch.tensor([predictor(x) for predictor in self.predictors]))
+        return self.batch_forward(x.unsqueeze(0), torch.tensor([x.shape[1]]))[0]
+
+    def batch_forward(self, x, lengths):
+        # (members, videos, scores) outputs combined over the members
+        return self.aggregation(self.member_outputs(x, lengths).permute(1,2,0))
+
+    def member_outputs(self, x, lengths):
+        first = self.predictors[0]
+        if self.stackable():
+            # all members differ only by their neutral elements: one batched uninorm over the stacked parameters
+            return first.batch_forward(x, lengths, torch.stack([predictor.neutral for predictor in self.predictors]))
+        return torch.stack([batch_outputs(predictor, x, lengths) for predictor in self.predictors])
+
+    def stackable(self):
+        first = self.predictors[0]
+        return all(isinstance(predictor, UninormAggregator) and not isinstance(predictor.fc, nn.Module) and
+                   predictor.tnorm is first.tnorm and predictor.off_diagonal_aggregation is first.off_diagonal_aggregation and
+                   predictor.normalize_neutral == first.normalize_neutral for predictor in self.predictors)
 
     def add_predictor(self, predictor):
         self.predictors.append(predictor)            
@@ -45,6 +65,9 @@ class UninormAggregator(nn.Module):
             self.off_diagonal_aggregation = max_aggregation
         else:
             raise Exception('Unknown off-diagonal aggregator: ' + off_diagonal)   
+        # the same choices as integer constants, for the kernel shared with the TorchScript aggregator
+        self.tnorm_code = TNORMS[tnorm]
+        self.off_diagonal_code = OFF_DIAGONALS[off_diagonal]
         self.normalize_neutral = normalize_neutral
         self.fc = (lambda x : x)        
 
@@ -53,10 +76,10 @@ class UninormAggregator(nn.Module):
 
     def print_parameters(self):
         for p in self.parameters():
-            print(p.name,p.data,p.requires_grad)
+            text_log.info("%s %s %s", p.name, p.data, p.requires_grad)
 
     def print_gradient(self):
-        print(self.neutral.grad)
+        text_log.info("%s", self.neutral.grad)
 
     def init_params(self, params):
         self.neutral = nn.Parameter(params)    
@@ -95,22 +118,90 @@ class UninormAggregator(nn.Module):
     def clamp_params(self):
         self.neutral.data.clamp_(0.,1.)
 
+    def stream(self, num_frames=None):
+        return StreamingUninorm(self, num_frames)
+
+    def batch_forward(self, x, lengths, neutral=None):
+        # x is a (videos, scores, frames) batch zero padded to the longest video
+        # neutral may carry leading dimensions, e.g. (configurations, scores) for stacked parameters
+        if neutral is None:
+            neutral = self.neutral
+        neutral = neutral.unsqueeze(-2)
+        if self.normalize_neutral:
+            neutral = neutral / lengths.unsqueeze(-1).float()
+        return self.fc(self.batch_uninorm(x, lengths, neutral))
+
+    def batch_uninorm(self, x, lengths, neutral):
+        # neutral broadcasts to x.shape[:-1], e.g. (candidates, videos, scores) for a (videos, scores, frames) batch
+        return uninorm_tree(x, lengths, neutral, self.tnorm_code, self.off_diagonal_code)
+
+    def pair_uninorm(self, a, b, neutral):
+        return uninorm_pair(a, b, neutral, self.tnorm_code, self.off_diagonal_code)
+
+class StreamingUninorm:
+    # Incremental evaluation of a UninormAggregator: frames (scores,) or chunks (scores, frames) are pushed in order.
+    # With the number of frames known, the state is the stack of completed subtrees of the halving brackets of
+    # UninormAggregator.uninorm, so the final score matches the batch forward up to rounding for every off-diagonal
+    # aggregation. Without it the frames are folded left to right, which only gives the same result when the
+    # uninorm is associative (min/max off-diagonal aggregation).
+
+    def __init__(self, aggregator, num_frames=None):
+        if num_frames is None and aggregator.normalize_neutral:
+            raise Exception('The number of frames is needed to stream with normalized neutral elements')
+        if num_frames is None and aggregator.off_diagonal_code == MEAN:
+            raise Exception('The number of frames is needed to stream with the mean off-diagonal aggregation')
+        if aggregator.normalize_neutral:
+            self.neutral = aggregator.neutral.detach() / num_frames
+        else:
+            self.neutral = aggregator.neutral.detach()
+        self.aggregator = aggregator
+        self.length = num_frames
+        self.reset()
+
+    def reset(self):
+        self.stack = []
+        self.num_frames = 0
+
+    def update(self, x):
+        with torch.no_grad():
+            frames = x.unsqueeze(-1) if x.dim() == 1 else x
+            if self.length is not None and self.num_frames + frames.shape[-1] > self.length:
+                raise Exception('More than the %d frames of the stream' %self.length)
+            for frame in frames.unbind(-1):
+                if self.length is None:
+                    self.stack = [frame if not self.stack else self.aggregator.pair_uninorm(self.stack[0], frame, self.neutral)]
+                else:
+                    self.stack = stream_push(self.stack, frame, self.num_frames, self.length, self.neutral,
+                                             self.aggregator.tnorm_code, self.aggregator.off_diagonal_code)
+                self.num_frames += 1
+        return self.score()
+
+    def score(self):
+        # before the last frame, the score of the video with the missing frames set to the neutral element
+        with torch.no_grad():
+            return self.aggregator.fc(stream_value(self.stack, self.neutral, self.aggregator.tnorm_code, self.aggregator.off_diagonal_code))
+
 class CovidNoCovidNet(nn.Module):
 
     def __init__(self, num_params, tnorm="lukasiewicz", normalize_neutral=False, init_neutral=0., off_diagonal='min'):
         super(CovidNoCovidNet, self).__init__()
 
-        self.local_aggregator = UninormAggregator(num_params-1, tnorm, normalize_neutral, init_neutral, off_diagonal, True)
+        # the positive scores of each frame are merged into a single covid score with one shared neutral element
+        self.local_aggregator = UninormAggregator(1, tnorm, normalize_neutral, init_neutral, off_diagonal)
         self.global_aggregator = UninormAggregator(2, tnorm, normalize_neutral, init_neutral, off_diagonal)
 
     def forward(self, x):
-        x_neg = x[0,:]
-        x_pos = self.local_aggregator(x[1:,:].t())
-        return self.global_aggregator(torch.stack((x_neg, x_pos)))
+        return self.batch_forward(x.unsqueeze(0), torch.tensor([x.shape[1]]))[0]
+
+    def batch_forward(self, x, lengths):
+        x_neg = x[:,0,:]
+        positive = x[:,1:,:].permute(0,2,1)
+        x_pos = self.local_aggregator.batch_forward(positive, torch.full(positive.shape[:1], positive.shape[2], dtype=torch.long))
+        return self.global_aggregator.batch_forward(torch.stack((x_neg, x_pos), dim=1), lengths)
 
     def print_parameters(self):
         for p in self.parameters():
-            print(p.name,p.data,p.requires_grad)
+            text_log.info("%s %s %s", p.name, p.data, p.requires_grad)
 
     def print_gradient(self):
         self.local_aggregator.print_gradient()
@@ -137,9 +228,19 @@ class ScoreHierarchyNet(nn.Module):
             output[1:] = self.score_aggregator(x[1:,:])
         return output
 
+    def batch_forward(self, x, lengths):
+        # same as forward with the per-video branch replaced by a mask over the batch
+        means = torch.sum(x,dim=-1) / lengths.unsqueeze(-1).float()
+        pos_neg = F.softmax(torch.stack((means[:,0], torch.sum(means[:,1:],dim=-1)),dim=-1),dim=-1)
+        scores = self.score_aggregator.batch_forward(x[:,1:,:], lengths)
+        negative = pos_neg[:,0] >= 0.5
+        output_neg = torch.where(negative, pos_neg[:,0], torch.zeros_like(pos_neg[:,0]))
+        output_pos = torch.where(negative.unsqueeze(-1), pos_neg[:,1:] * F.softmax(scores,dim=-1), scores)
+        return torch.cat((output_neg.unsqueeze(-1), output_pos), dim=-1)
+
     def print_parameters(self):
         for p in self.parameters():
-            print(p.name,p.data,p.requires_grad)
+            text_log.info("%s %s %s", p.name, p.data, p.requires_grad)
 
     def print_gradient(self):
         self.score_aggregator.print_gradient()
@@ -148,24 +249,142 @@ class ScoreHierarchyNet(nn.Module):
         self.score_aggregator.clamp_params()
 
 
+# Batched uninorm kernel, shared by UninormAggregator and the TorchScript aggregator in script.py. The t-norm/t-conorm
+# pair and the off-diagonal aggregation are selected by integer constants so that the functions can be scripted.
+
+LUKASIEWICZ = 0
+PRODUCT = 1
+TNORMS = {'lukasiewicz' : LUKASIEWICZ, 'product' : PRODUCT}
+
+MIN = 0
+MEAN = 1
+MAX = 2
+OFF_DIAGONALS = {'min' : MIN, 'mean' : MEAN, 'max' : MAX}
+
+def uninorm_tree(x, lengths, neutral, tnorm: int, off_diagonal: int):
+    # neutral broadcasts to x.shape[:-1]. The frames are laid out on a binary tree with the brackets of
+    # UninormAggregator.uninorm and reduced pairwise level by level
+    neutral = neutral.unsqueeze(-1)
+    x = halving_layout(x, lengths, neutral)
+    while x.shape[-1] > 1:
+        x = uninorm_pair(x[...,0::2], x[...,1::2], neutral, tnorm, off_diagonal)
+    return x[...,0]
+
+def uninorm_pair(a, b, neutral, tnorm: int, off_diagonal: int):
+    # elementwise counterpart of UninormAggregator.min_uninorm, with masks replaced by torch.where
+    pair = torch.stack((a, b), dim=-1)
+    neutral_full = neutral.unsqueeze(-1)
+    ones = torch.ones_like(neutral_full)
+    y_00 = neutral * t_norm(torch.div(pair, torch.where(neutral_full > 0, neutral_full, ones)), tnorm)
+    y_11 = neutral + (1 - neutral) * t_conorm(torch.div(pair - neutral_full, torch.where(neutral_full < 1, 1 - neutral_full, ones)), tnorm)
+    y_xx = off_diagonal_aggregation(pair, off_diagonal)
+    mask_00 = (a <= neutral) & (b <= neutral)
+    mask_11 = (a >= neutral) & (b >= neutral)
+    return torch.where(mask_11, y_11, torch.where(mask_00, y_00, y_xx))
+
+def stream_merges(frame: int, num_frames: int) -> int:
+    # number of subtrees of the halving brackets of a num_frames video whose last frame is frame, i.e. the merges
+    # to do once it is pushed on the stack of completed subtrees
+    merges = 0
+    count = num_frames
+    while count > 1:
+        if frame == count - 1:
+            merges += 1
+        half = count // 2
+        if frame >= half:
+            frame -= half
+            count -= half
+        else:
+            count = half
+    return merges
+
+def stream_push(stack: List[torch.Tensor], value, frame: int, num_frames: int, neutral, tnorm: int, off_diagonal: int) -> List[torch.Tensor]:
+    # pushes the value of a frame and merges the subtrees it completes: the stack holds O(log num_frames) partial
+    # aggregates and every frame costs one merge on average
+    stack.append(value)
+    for _ in range(stream_merges(frame, num_frames)):
+        right = stack.pop()
+        left = stack.pop()
+        stack.append(uninorm_pair(left, right, neutral, tnorm, off_diagonal))
+    return stack
+
+def stream_value(stack: List[torch.Tensor], neutral, tnorm: int, off_diagonal: int):
+    # the value of the tree with the frames not pushed yet set to the neutral element: each open subtree merges its
+    # completed left part with the value of its right part
+    if len(stack) == 0:
+        return neutral
+    value = stack[-1]
+    for i in range(len(stack) - 2, -1, -1):
+        value = uninorm_pair(stack[i], value, neutral, tnorm, off_diagonal)
+    return value
+
+def t_norm(x, tnorm: int):
+    if tnorm == PRODUCT:
+        return product_tnorm(x)
+    return lukasiewicz_tnorm(x)
+
+def t_conorm(x, tnorm: int):
+    if tnorm == PRODUCT:
+        return product_tconorm(x)
+    return lukasiewicz_tconorm(x)
+
+def off_diagonal_aggregation(x, off_diagonal: int):
+    if off_diagonal == MIN:
+        return min_aggregation(x)
+    if off_diagonal == MAX:
+        return max_aggregation(x)
+    return mean_aggregation(x)
+
+def halving_layout(x, lengths, neutral):
+    # Places the first length frames of each (videos, scores, frames) video on the leaves of a full binary tree as
+    # UninormAggregator.uninorm splits them (the first half of the frames to the left subtree, the rest to the right
+    # one), so that reducing adjacent pairs gives the same brackets. Free leaves hold the neutral element, which the
+    # uninorm leaves unchanged. neutral is broadcast to x.shape[:-1] + (1,)
+    num_frames = x.shape[-1]
+    width = 1
+    while width < num_frames:
+        width *= 2
+    frame = torch.arange(num_frames, device=x.device).unsqueeze(0).expand(lengths.shape[0], num_frames)
+    count = lengths.to(x.device).unsqueeze(-1).expand(lengths.shape[0], num_frames)
+    slot = torch.zeros_like(frame)
+    subtree = width // 2
+    while subtree > 0:
+        half = count // 2
+        right = frame >= half
+        slot = slot + right.long() * subtree
+        frame = torch.where(right, frame - half, frame)
+        count = torch.where(right, count - half, half)
+        subtree = subtree // 2
+    frames = torch.arange(num_frames, device=x.device).unsqueeze(0).expand(lengths.shape[0], num_frames)
+    slot = torch.where(frames < lengths.to(x.device).unsqueeze(-1), slot, torch.full_like(slot, width))
+    source = torch.full((lengths.shape[0], width + 1), -1, dtype=torch.long, device=x.device)
+    source = source.scatter(1, slot, frames)[:,:width]
+    index = source.clamp(min=0).unsqueeze(-2).expand(x.shape[0], x.shape[1], width)
+    return torch.where((source >= 0).unsqueeze(-2), torch.gather(x, -1, index), neutral)
+
+def batch_outputs(net, x, lengths):
+    if hasattr(net, 'batch_forward'):
+        return net.batch_forward(x, lengths)
+    return torch.stack([net(video[:,:length]) for video, length in zip(x, lengths)])
+
 def lukasiewicz_tnorm(x):
-    return torch.max(torch.zeros(x.shape[0]), torch.sum(x,1)-1) 
+    return torch.clamp(torch.sum(x,-1)-1, min=0.)
 
 def lukasiewicz_tconorm(x):
-    return torch.min(torch.ones(x.shape[0]),torch.sum(x,1)) 
+    return torch.clamp(torch.sum(x,-1), max=1.)
 
 def product_tnorm(x):
-    return torch.prod(x,dim=1)
+    return torch.prod(x,dim=-1)
 
 def product_tconorm(x):
-    return torch.sum(x,dim=1) - torch.prod(x,dim=1)
+    return torch.sum(x,dim=-1) - torch.prod(x,dim=-1)
 
 def min_aggregation(x):
-    return torch.min(x, dim=1).values 
+    return torch.min(x, dim=-1).values 
 
 def mean_aggregation(x):
-    return torch.mean(x, dim=1)
+    return torch.mean(x, dim=-1)
 
 def max_aggregation(x):
-    return torch.max(x, dim=1).values 
+    return torch.max(x, dim=-1).values 
 
@@ -0,0 +1,86 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from typing import List
+
+from aggregator.nn import TNORMS, OFF_DIAGONALS, MEAN, uninorm_tree, stream_push, stream_value
+
+# TorchScript counterpart of nn.UninormAggregator, running the batched kernel of aggregator.nn, so the module can
+# be compiled with torch.jit.script and run without the Python interpreter.
+# The parameter names match UninormAggregator, so its state_dicts load unchanged.
+
+class ScriptUninormAggregator(nn.Module):
+    __constants__ = ['tnorm', 'off_diagonal', 'normalize_neutral']
+
+    def __init__(self, num_params, tnorm="lukasiewicz", normalize_neutral=False, init_neutral=0., off_diagonal='min', linear=False):
+        super(ScriptUninormAggregator, self).__init__()
+        if tnorm not in TNORMS:
+            raise Exception('Unknown tnorm: ' + tnorm)
+        if off_diagonal not in OFF_DIAGONALS:
+            raise Exception('Unknown off-diagonal aggregator: ' + off_diagonal)
+        self.num_params = num_params
+        self.neutral = nn.Parameter(torch.ones(num_params) * init_neutral)
+        self.tnorm = TNORMS[tnorm]
+        self.off_diagonal = OFF_DIAGONALS[off_diagonal]
+        self.normalize_neutral = normalize_neutral
+        # the identity has no parameters, so state_dicts saved without activate_linear load as well
+        self.fc = nn.Linear(num_params, num_params) if linear else nn.Identity()
+
+    def forward(self, x):
+        # x is a (scores, frames) video
+        return self.batch_forward(x.unsqueeze(0), torch.tensor([x.shape[1]], device=x.device))[0]
+
+    def batch_forward(self, x, lengths):
+        # x is a (videos, scores, frames) batch zero padded to the longest video
+        neutral = self.neutral.unsqueeze(0)
+        if self.normalize_neutral:
+            neutral = neutral / lengths.unsqueeze(-1).float()
+        return self.fc(uninorm_tree(x, lengths, neutral, self.tnorm, self.off_diagonal))
+
+    # Incremental evaluation as in nn.StreamingUninorm: the frames of a num_frames video are pushed in order on a
+    # stack of completed subtrees of the training brackets, so every frame is aggregated once and the score after
+    # the last frame is the forward of the whole video
+
+    @torch.jit.export
+    def stream_neutral(self, num_frames: int):
+        # the neutral element of a video of num_frames frames
+        if self.normalize_neutral:
+            return self.neutral.detach() / num_frames
+        return self.neutral.detach()
+
+    @torch.jit.export
+    def stream_update(self, stack: List[torch.Tensor], seen: int, x, neutral, num_frames: int) -> List[torch.Tensor]:
+        # pushes a (scores, frames) chunk following the seen frames already on the stack
+        for i in range(x.shape[1]):
+            stack = stream_push(stack, x[:,i], seen + i, num_frames, neutral, self.tnorm, self.off_diagonal)
+        return stack
+
+    @torch.jit.export
+    def associative(self) -> bool:
+        # whether the frames can be pushed in any order: the uninorm is associative for the min/max off-diagonal
+        # aggregations only
+        return self.off_diagonal != MEAN
+
+    @torch.jit.export
+    def stream_score(self, stack: List[torch.Tensor], neutral):
+        return self.fc(stream_value(stack, neutral, self.tnorm, self.off_diagonal))
+
+class VideoScorer(nn.Module):
+    # Frames to video score in one module: the frame model (e.g. a traced CNNConStn returning (logits, scaling),
+    # with the logits of the two STN crops stacked along the batch) followed by the aggregator on its softmax scores
+
+    def __init__(self, frame_model, aggregator):
+        super(VideoScorer, self).__init__()
+        self.frame_model = frame_model
+        self.aggregator = aggregator
+
+    def forward(self, frames):
+        logits = self.frame_model(frames)[0][:frames.shape[0]]
+        return self.aggregator(F.softmax(logits, dim=1).t())
+
+def load_script_net(modelfile, score_range, args):
+    state_dict = torch.load(modelfile, map_location='cpu')
+    net = ScriptUninormAggregator(score_range, tnorm=args.tnorm, normalize_neutral=args.normalize_neutral, off_diagonal=args.off_diagonal, linear='fc.weight' in state_dict)
+    net.load_state_dict(state_dict)
+    return net
@@ -0,0 +1,135 @@
+import asyncio
+import json
+import time
+import torch
+import numpy as np
+from collections import deque
+from torch.nn.functional import softmax
+from torch.nn.utils.rnn import pad_sequence
+from aggregator.nn import batch_outputs
+
+REASONS = {200 : 'OK', 400 : 'Bad Request', 404 : 'Not Found'}
+
+class BatchingService:
+	"""Serves video-level score probabilities over HTTP. Concurrent requests are queued and evaluated together
+	in one padded forward, the next batch collecting whatever arrived while the previous one was running.
+
+	POST /predict {"scores": [[...], ...]} with one row of frame-level scores per frame
+	GET /stats latency, batching and queue-depth counters
+	"""
+
+	def __init__(self, net, num_scores, max_batch=64, max_delay=0.002):
+		self.net = net
+		self.num_scores = num_scores
+		self.max_batch = max_batch
+		self.max_delay = max_delay
+		self.latencies = deque(maxlen=10000)
+		self.num_requests = 0
+		self.num_batches = 0
+		self.forward_time = 0.
+
+	async def run(self, host='127.0.0.1', port=8000, unix_socket=None):
+		self.queue = asyncio.Queue()
+		batcher = asyncio.ensure_future(self.batcher())
+		if unix_socket:
+			server = await asyncio.start_unix_server(self.handle, path=unix_socket)
+			print("Serving on ", unix_socket)
+		else:
+			server = await asyncio.start_server(self.handle, host, port)
+			print("Serving on %s:%d" %(host, port))
+		try:
+			async with server:
+				await server.serve_forever()
+		finally:
+			batcher.cancel()
+
+	async def predict(self, scores):
+		future = asyncio.get_event_loop().create_future()
+		await self.queue.put((scores, future, time.perf_counter()))
+		return await future
+
+	async def batcher(self):
+		loop = asyncio.get_event_loop()
+		while True:
+			batch = [await self.queue.get()]
+			if self.max_delay:
+				await asyncio.sleep(self.max_delay)
+			while len(batch) < self.max_batch and not self.queue.empty():
+				batch.append(self.queue.get_nowait())
+			start = time.perf_counter()
+			try:
+				probabilities = await loop.run_in_executor(None, self.forward, [scores for scores, _, _ in batch])
+			except Exception as e:
+				for _, future, _ in batch:
+					if not future.done():
+						future.set_exception(e)
+				continue
+			end = time.perf_counter()
+			self.forward_time += end - start
+			self.num_batches += 1
+			for (_, future, arrival), p in zip(batch, probabilities):
+				self.num_requests += 1
+				self.latencies.append(end - arrival)
+				if not future.done():
+					future.set_result(p)
+
+	def forward(self, inputs):
+		lengths = torch.tensor([x.shape[1] for x in inputs])
+		x = pad_sequence([x.t() for x in inputs], batch_first=True).permute(0,2,1)
+		with torch.no_grad():
+			return softmax(batch_outputs(self.net, x, lengths), dim=-1).tolist()
+
+	def get_stats(self):
+		latencies = np.array(self.latencies) * 1000
+		stats = {'requests' : self.num_requests,
+				 'batches' : self.num_batches,
+				 'mean_batch_size' : self.num_requests / max(self.num_batches, 1),
+				 'queue_depth' : self.queue.qsize(),
+				 'forward_time_s' : self.forward_time}
+		if len(latencies):
+			stats.update({'latency_mean_ms' : latencies.mean(),
+						  'latency_p50_ms' : np.percentile(latencies, 50),
+						  'latency_p95_ms' : np.percentile(latencies, 95),
+						  'latency_p99_ms' : np.percentile(latencies, 99)})
+		return stats
+
+	async def route(self, method, target, body):
+		if method == 'GET' and target == '/stats':
+			return 200, self.get_stats()
+		if method == 'POST' and target == '/predict':
+			try:
+				scores = torch.tensor(json.loads(body)['scores'], dtype=torch.float32)
+				if scores.dim() != 2 or scores.shape[0] == 0 or scores.shape[1] != self.num_scores:
+					raise ValueError('expected a (frames, %d) matrix of frame scores' %self.num_scores)
+			except (ValueError, KeyError, TypeError) as e:
+				return 400, {'error' : str(e)}
+			probabilities = await self.predict(scores.t())
+			return 200, {'probabilities' : probabilities, 'score' : int(np.argmax(probabilities))}
+		return 404, {'error' : 'unknown endpoint %s %s' %(method, target)}
+
+	async def handle(self, reader, writer):
+		# minimal HTTP/1.1 with keep-alive, enough for local clients and the load generator
+		try:
+			while True:
+				request_line = await reader.readline()
+				if not request_line:
+					break
+				method, target, _ = request_line.decode().split(' ', 2)
+				headers = {}
+				while True:
+					line = await reader.readline()
+					if line in (b'\r\n', b'\n', b''):
+						break
+					name, value = line.decode().split(':', 1)
+					headers[name.strip().lower()] = value.strip()
+				body = await reader.readexactly(int(headers.get('content-length', 0)))
+				status, response = await self.route(method, target, body)
+				payload = json.dumps(response).encode()
+				writer.write(('HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n' %(status, REASONS[status], len(payload))).encode() + payload)
+				await writer.drain()
+				if headers.get('connection', '').lower() == 'close':
+					break
+		except (asyncio.IncompleteReadError, ConnectionResetError, ValueError):
+			pass
+		finally:
+			writer.close()
@@ -2,13 +2,15 @@ import torch
 import torch.optim as optim
 import torch.nn as nn
 from torch.nn.functional import softmax
-from aggregator.nn import UninormAggregator, ScoreHierarchyNet, CovidNoCovidNet
+from aggregator.nn import UninormAggregator, ScoreHierarchyNet, CovidNoCovidNet, batch_outputs
 from aggregator.util import *
-from sklearn.metrics import confusion_matrix, accuracy_score, classification_report, f1_score, precision_score, recall_score, roc_curve, roc_auc_score
-from sklearn.preprocessing import label_binarize
-import matplotlib.pyplot as plt
+from aggregator.logger import logger, text_log, parameter_values, FOLD, EPOCH, DEBUG
 from threading import Thread
-import pickle
+import time
+from itertools import product
+from copy import copy
+import pandas as pd
+import json
 
 class TrainThread(Thread):
 
@@ -21,27 +23,56 @@ class TrainThread(Thread):
 		self.outputfile = args[3]
 		self.score_range = args[4]
 		self.args = args[5]
+		self.init_state = args[6]
 		self._return = 0
 
 	def run(self):
-		net = train(self.trainset, self.modelfile, self.score_range, self.args)
+		start = time.perf_counter()
+		net = train(self.trainset, self.modelfile, self.score_range, self.args, self.init_state)
+		middle = time.perf_counter()
 		self._return = test(net, self.testset, self.outputfile, self.score_range) 
+		log_fold(self.modelfile, self.trainset, self._return, middle - start, time.perf_counter() - middle)
 
 	def join(self, *args):
 		Thread.join(self, *args)
 		return self._return
 
-def train(dataset, modelfile, score_range, args):
-	
+def build_net(score_range, args):
 	if args.use_binary_labels:
-		net = CovidNoCovidNet(score_range, tnorm=args.tnorm, normalize_neutral=args.normalize_neutral, init_neutral=args.init_neutral)
+		return CovidNoCovidNet(score_range, tnorm=args.tnorm, normalize_neutral=args.normalize_neutral, init_neutral=args.init_neutral, off_diagonal=args.off_diagonal)
 	elif args.use_score_hierarchy:
-		net = ScoreHierarchyNet(score_range, tnorm=args.tnorm, normalize_neutral=args.normalize_neutral, init_neutral=args.init_neutral)
+		return ScoreHierarchyNet(score_range, tnorm=args.tnorm, normalize_neutral=args.normalize_neutral, init_neutral=args.init_neutral, off_diagonal=args.off_diagonal)
 	else:
-		net = UninormAggregator(score_range, tnorm=args.tnorm, normalize_neutral=args.normalize_neutral, init_neutral=args.init_neutral)
+		return UninormAggregator(score_range, tnorm=args.tnorm, normalize_neutral=args.normalize_neutral, init_neutral=args.init_neutral, off_diagonal=args.off_diagonal)
+
+def load_state(net, state_dict):
+	# linear layers activated during training have to exist before their weights are loaded
+	for name, module in net.named_modules():
+		if isinstance(module, UninormAggregator) and (name + '.' if name else '') + 'fc.weight' in state_dict:
+			module.activate_linear()
+	net.load_state_dict(state_dict)
+
+def load_net(modelfile, score_range, args):
+	net = build_net(score_range, args)
+	load_state(net, torch.load(modelfile))
+	return net
 
-	optimizer = optim.Adam(net.parameters(), lr=args.lr)#, weight_decay=0.01)
-	lr_scheduler = optim.lr_scheduler.MultiStepLR(optimizer, [15, 20, 25], gamma=args.lr_gamma)
+def train(dataset, modelfile, score_range, args, init_state=None):
+	
+	train_start = time.perf_counter()
+	net = build_net(score_range, args)
+	if init_state is not None:
+		load_state(net, init_state)
+
+	if args.optimizer == 'lbfgs':
+		if args.activate_linear:
+			raise Exception('L-BFGS does not support activating the linear layer during training')
+		# one L-BFGS iteration per epoch, so that parameters are projected to [0,1] after every step
+		optimizer = optim.LBFGS(net.parameters(), lr=1, max_iter=1, line_search_fn='strong_wolfe')
+		lr_scheduler = None
+	else:
+		optimizer = optim.Adam(net.parameters(), lr=args.lr)#, weight_decay=0.01)
+		lr_scheduler = optim.lr_scheduler.MultiStepLR(optimizer, [15, 20, 25], gamma=args.lr_gamma)
 
 	if args.loss == "kl":
 		criterion = kl_div_loss
@@ -53,168 +84,286 @@ def train(dataset, modelfile, score_range, args):
 	else:
 		score_weight = None
 
-	max_accuracy = 0.0
-	max_loss = 0.0
-	
-	for epoch in range(args.epochs):
+	epochs = args.epochs
+	if args.optimizer == 'search':
+		search_neutral(net, dataset, criterion, score_weight, args)
+		epochs = args.refine_epochs
+
+	def closure():
+		# full-batch loss summed over the videos, the objective whose gradient the epoch loop accumulates.
+		# No projection here: the line search and the curvature pairs assume the step x + t*d was taken
+		optimizer.zero_grad()
+		total_loss = 0.0
+		for x, label in dataset:
+			loss = criterion(net(x).view(1,-1), label, use_sord=args.use_sord, zero_score_gap=args.zero_score_gap, weight=score_weight)
+			loss.backward()
+			total_loss += loss.item()
+		return total_loss
+
+	def epoch_losses(epoch):
+		# the videos are forwarded one at a time and the loss of each is backpropagated right away
+		forward_time = 0.0
+		backward_time = 0.0
 		running_loss = 0.0		
 		running_accuracy = 0.0					
 		num = 0
-		if args.activate_linear and args.activate_linear == epoch: 
+		if args.activate_linear and args.activate_linear == epoch and not isinstance(net.fc, nn.Module): 
 			net.activate_linear()
 			optimizer.add_param_group({"params": net.fc.parameters()})
-		optimizer.zero_grad()	
 		for x, label in dataset:			
+			start = time.perf_counter()
 			y = net(x).view(1,-1)			
 			loss = criterion(y, label, use_sord=args.use_sord, zero_score_gap=args.zero_score_gap, weight=score_weight)
+			middle = time.perf_counter()
 			loss.backward()			
 			#torch.nn.utils.clip_grad_norm_(net.parameters(), 0.005)						
+			backward_time += time.perf_counter() - middle
+			forward_time += middle - start
 			running_loss += loss.item()					
-			running_accuracy += label == torch.argmax(y)
+			running_accuracy += (label == torch.argmax(y)).float().item()
 			num +=1			
-		running_accuracy /= num
-		running_loss /= num		
-		print("parameters")
-		net.print_parameters()
-		print("gradient")
-		net.print_gradient()
-		print('[%d] accuracy: %.3f' % (epoch + 1, running_accuracy))
-		print('[%d] loss: %.3f' % (epoch + 1, running_loss))		
-		max_accuracy, max_loss = save_checkpoint(net, modelfile, args.earlystop, running_accuracy, running_loss, max_accuracy, max_loss)
-		optimizer.step()
-		if not args.normalize_neutral:
-			net.clamp_params()
-		lr_scheduler.step()
-	
-	if args.earlystop != "last":
-		net.load_state_dict(torch.load(modelfile))
+		return torch.tensor([running_loss / num]), torch.tensor([running_accuracy / num]), forward_time, backward_time, num
+
+	epochs = fit(net, modelfile, [args], optimizer, lr_scheduler, epochs, epoch_losses, closure)
+	torch.save(net.state_dict(), modelfile)
 	
-	print("learned parameters")
+	text_log.info("learned parameters")
 	net.print_parameters()
+	train_time = time.perf_counter() - train_start
+	text_log.info("Trained %d epochs in %.2f s" %(epochs, train_time))
+	logger.log('train', FOLD, model=modelfile, epochs=epochs, train_time=train_time)
 	
 	return net
 
-def save_checkpoint(net, modelfile, earlystop, running_accuracy, running_loss, max_accuracy, max_loss):
+def fit(net, modelfile, configs, optimizer, lr_scheduler, epochs, epoch_losses, closure=None):
+	# Epoch loop shared by train and train_batched. epoch_losses(epoch) accumulates the gradient of the training
+	# losses of the configurations and returns them with the (configurations,) accuracies, the forward and backward
+	# times and the number of videos. A configuration whose loss changed by less than args.tolerance is frozen and
+	# training stops once all of them are. The best state of args.earlystop is kept for a single configuration.
+	# :return: number of epochs run
+	args = configs[0]
+	best_state = None
+	max_accuracy = 0.0
+	min_loss = float('inf')
+	previous_loss = None
+	converged = torch.zeros(len(configs), dtype=torch.bool)
+	rows = (lambda values : values[0].item()) if len(configs) == 1 else (lambda values : values.tolist())
+
+	for epoch in range(epochs):
+		epoch_start = time.perf_counter()
+		optimizer.zero_grad()	
+		running_loss, running_accuracy, forward_time, backward_time, num = epoch_losses(epoch)
+		if logger.enabled(DEBUG):
+			text_log.info("parameters")
+			net.print_parameters()
+			text_log.info("gradient")
+			net.print_gradient()
+		if len(configs) == 1:
+			text_log.info('[%d] accuracy: %.3f' % (epoch + 1, running_accuracy[0]))
+			text_log.info('[%d] loss: %.3f' % (epoch + 1, running_loss[0]))		
+		else:
+			for i in range(len(configs)):
+				text_log.info('[%d] configuration %d accuracy: %.3f loss: %.3f' % (epoch + 1, i, running_accuracy[i], running_loss[i]))
+		wall_time = time.perf_counter() - epoch_start
+		logger.log('epoch', EPOCH, model=modelfile, epoch=epoch + 1, loss=rows(running_loss), accuracy=rows(running_accuracy),
+				   parameters=parameter_values(net), wall_time=wall_time, forward_time=forward_time,
+				   backward_time=backward_time, videos_per_sec=num * len(configs) / wall_time)
+		if len(configs) == 1:
+			best_state, max_accuracy, min_loss = save_checkpoint(net, best_state, args.earlystop, running_accuracy[0].item(), running_loss[0].item(), max_accuracy, min_loss)
+		if args.tolerance and previous_loss is not None:
+			stopped = ~converged & ((previous_loss - running_loss).abs() < args.tolerance)
+			for i in stopped.nonzero().view(-1).tolist():
+				text_log.info("Converged after %d epochs" %(epoch + 1) if len(configs) == 1 else "Configuration %d converged after %d epochs" %(i, epoch + 1))
+			converged |= stopped
+			if converged.all():
+				break
+		previous_loss = running_loss
+		if converged.any():
+			# only reached with stacked configurations, whose rows are the (configurations, scores) neutral elements
+			frozen = net.neutral.detach().clone()
+		if lr_scheduler is None:
+			# the gradient of the current parameters has just been accumulated, no need to recompute it
+			cached_loss = [running_loss[0].item() * num]
+			optimizer.step(lambda: cached_loss.pop() if cached_loss else closure())
+			if not args.normalize_neutral:
+				before = [p.detach().clone() for p in net.parameters()]
+				net.clamp_params()
+				if any(not torch.equal(p, q) for p, q in zip(before, net.parameters())):
+					# the projected step is not the one the curvature history was built from
+					optimizer.state.clear()
+		else:
+			optimizer.step()
+			if not args.normalize_neutral:
+				net.clamp_params()
+		if converged.any():
+			net.neutral.data[converged] = frozen[converged]
+		if lr_scheduler is not None:
+			lr_scheduler.step()
+	
+	if best_state is not None:
+		net.load_state_dict(best_state)
+	return epoch + 1 if epochs else 0
+
+def search_neutral(net, dataset, criterion, score_weight, args):
+	if not isinstance(net, UninormAggregator):
+		raise Exception('Neutral search is only supported for the plain uninorm aggregator')
+	x, lengths, labels = dataset.get_batch()
+	grid = torch.linspace(0., 1., args.grid_size)
+	num_params = net.num_params
+	with torch.no_grad():
+		# the aggregated score of each class only depends on its own neutral element, so a single
+		# batched evaluation over the grid gives the outputs of every combination of neutral values
+		neutral = grid.view(-1, 1, 1).expand(-1, x.shape[0], num_params)
+		if args.normalize_neutral:
+			neutral = neutral / lengths.view(1, -1, 1).float()
+		outputs = net.batch_uninorm(x, lengths, neutral).permute(0,2,1)
+
+		def candidate_losses(candidates):
+			y = outputs[candidates, torch.arange(num_params)].permute(0,2,1)
+			return criterion(y, labels, use_sord=args.use_sord, zero_score_gap=args.zero_score_gap, weight=score_weight, reduction='none').mean(dim=-1)
+
+		if args.search == 'grid':
+			best_loss = float('inf')
+			# the grid_size**num_params combinations are enumerated by flat index, one chunk at a time
+			digits = args.grid_size ** torch.arange(num_params - 1, -1, -1)
+			for start in range(0, args.grid_size ** num_params, args.search_chunk):
+				chunk = torch.arange(start, min(start + args.search_chunk, args.grid_size ** num_params)).view(-1, 1) // digits % args.grid_size
+				losses = candidate_losses(chunk)
+				i = torch.argmin(losses)
+				if losses[i] < best_loss:
+					best_loss = losses[i].item()
+					best = chunk[i]
+		else:
+			best = torch.ones(num_params, dtype=torch.long) * int(round(args.init_neutral * (args.grid_size - 1)))
+			best_loss = candidate_losses(best.view(1, -1))[0].item()
+			improved = True
+			while improved:
+				improved = False
+				for p in range(num_params):
+					candidates = best.repeat(args.grid_size, 1)
+					candidates[:,p] = torch.arange(args.grid_size)
+					losses = candidate_losses(candidates)
+					i = torch.argmin(losses)
+					if losses[i] < best_loss:
+						best_loss = losses[i].item()
+						best = candidates[i]
+						improved = True
+		net.neutral.data = grid[best]
+	text_log.info("searched parameters")
+	net.print_parameters()
+	text_log.info('search loss: %.3f' % best_loss)
+
+def save_checkpoint(net, best_state, earlystop, running_accuracy, running_loss, max_accuracy, min_loss):
+	# the best state is kept in memory, train writes the final model once
 	if running_accuracy > max_accuracy:
 		max_accuracy = running_accuracy
 		if earlystop == 'train_acc':
-			torch.save(net.state_dict(), modelfile)
-	if running_loss > max_loss:
-		max_loss = running_loss
+			best_state = {name : value.detach().clone() for name, value in net.state_dict().items()}
+	if running_loss < min_loss:
+		min_loss = running_loss
 		if earlystop == 'train_loss':
-			torch.save(net.state_dict(), modelfile)			
-	return max_accuracy, max_loss
-
-def test(net, testset, outputfile, score_range):
+			best_state = {name : value.detach().clone() for name, value in net.state_dict().items()}
+	return best_state, max_accuracy, min_loss
 
-	inputs=[]
-	labels=[]		
-	outputs=[]
+BASELINES = {'argmax_mean' : batch_argmax_mean, 'max_argmax' : batch_max_argmax}
 
+def predict(net, testset):
+	# model and baselines evaluated once over the padded batch of test videos
+	x, lengths, labels = testset.get_batch()
 	with torch.no_grad():
-		for x, label in testset:
-			inputs.append(x)
-			labels.append(label)	
-			outputs.append(net(x))		
-
-		print("Predictor results")
-		preds=[torch.argmax(o) for o in outputs]
-		print_results(labels,preds,score_range)
-		save_predictions(labels,preds,outputfile)
-
-	baselines = (argmax_mean, max_argmax) #, argmax_count_argmax, max_thres_count_argmax_5, max_thres_count_argmax_10, max_thres_count_argmax_15)
-
-	for baseline in baselines:
-		baseline_preds=[]
-		for x, label in testset:
-			baseline_preds.append(baseline(x))
-		print("Baseline <%s> results" %baseline.__name__)
-		print_results(labels,baseline_preds,score_range)	
-
-	return inputs,labels,outputs,preds
-
-def evaluate(inputs, labels, outputs, preds, outprefix, score_range, kfolds=False):
-
-	baselines = (argmax_mean, max_argmax) #, argmax_count_argmax, max_thres_count_argmax_5, max_thres_count_argmax_10, max_thres_count_argmax_15)
-
-	if kfolds:	
-		print("Predictor average results")	
-		print_average_results(labels, preds)
-		
-		for baseline in baselines:
-			baseline_preds=[]
-			for fold_inputs in inputs:
-				baseline_preds.append([baseline(x) for x in fold_inputs])
-			print("Baseline <%s> average results" %baseline.__name__)
-			print_average_results(labels,baseline_preds)
-
-		inputs = flatten(inputs)
-		labels = flatten(labels)
-		outputs = flatten(outputs)
-		preds = flatten(preds)
-
-	print("Predictor overall results")
-	print_results(labels,preds,score_range)
-	save_predictions(labels,preds,outprefix + "_preds")
-	
-	for baseline in baselines:
-		baseline_preds=[]
-		for x, label in zip(inputs, labels):
-			baseline_preds.append(baseline(x))
-		print("Baseline <%s> overall results" %baseline.__name__)
-		print_results(labels,baseline_preds,score_range)
+		outputs = batch_outputs(net, x, lengths)
+	preds = {'Predictor' : torch.argmax(outputs, dim=-1)}
+	for name, baseline in BASELINES.items():
+		preds['Baseline <%s>' %name] = baseline(x, lengths)
+	return {'labels' : labels, 'outputs' : outputs, 'mean_inputs' : batch_mean(x, lengths), 'preds' : preds}
+
+def merge_predictions(folds):
+	return {'labels' : torch.cat([fold['labels'] for fold in folds]),
+			'outputs' : torch.cat([fold['outputs'] for fold in folds]),
+			'mean_inputs' : torch.cat([fold['mean_inputs'] for fold in folds]),
+			'preds' : {name : torch.cat([fold['preds'][name] for fold in folds]) for name in folds[0]['preds']}}
+
+def test(net, testset, outputfile, score_range):
+
+	predictions = predict(net, testset)
+	results = {}
+	for name, preds in predictions['preds'].items():
+		text_log.info("%s results" %name)
+		results[name] = print_results(predictions['labels'], preds, score_range)
+	save_predictions(predictions['labels'], predictions['preds']['Predictor'], outputfile)
+	save_results(results, outputfile + ".json")
+
+	return predictions
+
+def evaluate(folds, outprefix, score_range, kfolds=False):
+
+	results = {}
+	if kfolds:
+		results['average'] = {}
+		for name in folds[0]['preds']:
+			text_log.info("%s average results" %name)
+			results['average'][name] = print_average_results([fold['labels'] for fold in folds], [fold['preds'][name] for fold in folds], score_range)
+
+	predictions = merge_predictions(folds)
+	results['overall'] = {}
+	for name, preds in predictions['preds'].items():
+		text_log.info("%s overall results" %name)
+		results['overall'][name] = print_results(predictions['labels'], preds, score_range)
+	save_predictions(predictions['labels'], predictions['preds']['Predictor'], outprefix + "_preds")
+	save_results(results, outprefix + "_results.json")
 	
-	compute_roc_curve(inputs, labels, outputs, preds, outprefix, score_range)
+	compute_roc_curve(predictions['labels'], predictions['outputs'], predictions['mean_inputs'], outprefix, score_range)
+
+def log_fold(fold, trainset, predictions, train_time, test_time):
+	logger.log('fold', FOLD, fold=str(fold), train_videos=len(trainset), test_videos=len(predictions['labels']),
+			   train_time=train_time, test_time=test_time,
+			   accuracy=(predictions['preds']['Predictor'] == predictions['labels']).float().mean().item())
+
+def warm_start(dataset, outprefix, score_range, args):
+	# parameters fitted once on all the data, used as starting point of every fold
+	if not args.warm_start:
+		return None
+	text_log.info("Warm start computation on all data")
+	return train(dataset, outprefix + "_model.all", score_range, args).state_dict()
 
 def lopo(dataset, outprefix, score_range, args):
 
-	inputs=[]
-	labels=[]
-	outputs=[]	
-	preds=[]
+	folds=[]
+	init_state = warm_start(dataset, outprefix, score_range, args)
 
 	for patient in dataset.get_patient_indices():
-		print("LOPO computation for patient ", patient)
+		text_log.info("LOPO computation for patient %s", patient)
 		trainset = dataset.exclude_patient(patient)
 		testset = dataset.get_patient(patient)
-		net = train(trainset, "%s_model.%s" %(outprefix,str(patient)), score_range, args)
-		with torch.no_grad():
-			for x, label in testset:				
-				inputs.append(x)
-				labels.append(label)
-				outputs.append(net(x))
-				preds.append(torch.argmax(outputs[-1]))
+		start = time.perf_counter()
+		net = train(trainset, "%s_model.%s" %(outprefix,str(patient)), score_range, args, init_state)
+		middle = time.perf_counter()
+		folds.append(predict(net, testset))
+		log_fold(patient, trainset, folds[-1], middle - start, time.perf_counter() - middle)
 
-	evaluate(inputs, labels, outputs, preds, outprefix, score_range)
+	evaluate(folds, outprefix, score_range)
 
 def lovo(dataset, outprefix, score_range, args):
 
-	inputs=[]
-	labels=[]
-	outputs=[]	
-	preds=[]
+	folds=[]
+	init_state = warm_start(dataset, outprefix, score_range, args)
 
 	for video in dataset.get_indices():
-		print("LOVO computation for video ", video[2])
+		text_log.info("LOVO computation for video %s", video[2])
 		trainset = dataset.exclude_video(video)
 		testset = dataset.get_video(video)
-		net = train(trainset, "%s_model.%s" %(outprefix,video[2]), score_range, args)
-		with torch.no_grad():
-			for x, label in testset:				
-				inputs.append(x)
-				labels.append(label)
-				outputs.append(net(x))
-				preds.append(torch.argmax(outputs[-1]))
+		start = time.perf_counter()
+		net = train(trainset, "%s_model.%s" %(outprefix,video[2]), score_range, args, init_state)
+		middle = time.perf_counter()
+		folds.append(predict(net, testset))
+		log_fold(video, trainset, folds[-1], middle - start, time.perf_counter() - middle)
 
-	evaluate(inputs, labels, outputs, preds, outprefix, score_range)
+	evaluate(folds, outprefix, score_range)
 
 
 def kfolds(dataset, outprefix, score_range, args):
 
-	allinputs=[]
-	alllabels=[]
-	alloutputs=[]
-	allpreds=[]	
+	folds=[]
 	numfolds = args.numfolds
 	if args.stratified:
 		splits = dataset.get_stratified_kfold_splits(numfolds, score_range)
@@ -222,124 +371,230 @@ def kfolds(dataset, outprefix, score_range, args):
 		splits = dataset.get_kfold_splits(numfolds)
 	all = dataset.get_patient_indices()
 	train_threads = []
+	init_state = warm_start(dataset, outprefix, score_range, args)
 
-	print("Splits")
-	print(splits)
+	text_log.info("Splits")
+	text_log.info("%s", splits)
 	for i,split in enumerate(splits,0):		
 		trainset = dataset.get_patients(all.difference(split))
 		testset = dataset.get_patients(split)
 		if args.multithread:
-			print("Starting thread ", i)
+			text_log.info("Starting thread %d", i)
 			train_thread = TrainThread(args=(trainset, testset, 
 											 "%s_model.%d" %(outprefix,i), 
 											 "%s_preds.%d" %(outprefix,i), 
-											 score_range, args))
+											 score_range, args, init_state))
 			train_thread.start()
 			train_threads.append(train_thread)
 		else:
-			print("Running fold ", i)
-			net = train(trainset, "%s_model.%d" %(outprefix,i), score_range, args)		
-			inputs,labels,outputs,preds = test(net, testset, "%s_preds.%d" %(outprefix,i), score_range)
-			allinputs.append(inputs)
-			alllabels.append(labels)
-			alloutputs.append(outputs)
-			allpreds.append(preds)
+			text_log.info("Running fold %d", i)
+			start = time.perf_counter()
+			net = train(trainset, "%s_model.%d" %(outprefix,i), score_range, args, init_state)		
+			middle = time.perf_counter()
+			folds.append(test(net, testset, "%s_preds.%d" %(outprefix,i), score_range))
+			log_fold(i, trainset, folds[-1], middle - start, time.perf_counter() - middle)
 
 	if args.multithread:
 		for train_thread in train_threads:				
-			inputs,labels,outputs,preds = train_thread.join()
-			allinputs.append(inputs)
-			alllabels.append(labels)
-			alloutputs.append(outputs)
-			allpreds.append(preds)
+			folds.append(train_thread.join())
+
+	evaluate(folds, outprefix, score_range, kfolds=True)
+
+def train_batched(dataset, score_range, configs, init_state=None):
+	# Configurations sharing tnorm and off-diagonal are trained together on a (configurations, scores) neutral
+	# parameter. Configurations are independent, so summing their losses gives each row its own Adam update.
+	train_start = time.perf_counter()
+	args = configs[0]
+	net = UninormAggregator(score_range, tnorm=args.tnorm, normalize_neutral=args.normalize_neutral, init_neutral=args.init_neutral, off_diagonal=args.off_diagonal)
+	net.init_params(torch.ones(len(configs), score_range) * args.init_neutral)
+	if init_state is not None:
+		load_state(net, init_state)
+
+	optimizer = optim.Adam(net.parameters(), lr=args.lr)
+	lr_scheduler = optim.lr_scheduler.MultiStepLR(optimizer, [15, 20, 25], gamma=args.lr_gamma)
+
+	criteria = [kl_div_loss if config.loss == "kl" else cross_entropy_loss for config in configs]
+
+	if args.rebalance_scores:
+		score_weight = dataset.compute_score_weights()
+	else:
+		score_weight = None
 
-	evaluate(allinputs, alllabels, alloutputs, allpreds, outprefix, score_range, kfolds=True)
+	x, lengths, labels = dataset.get_batch()
+
+	def epoch_losses(epoch):
+		# one forward of the padded batch for all the configurations
+		start = time.perf_counter()
+		y = net.batch_forward(x, lengths)
+		losses = torch.stack([criterion(y[i], labels, use_sord=config.use_sord, zero_score_gap=config.zero_score_gap, weight=score_weight, reduction='none').sum()
+							  for i, (criterion, config) in enumerate(zip(criteria, configs))])
+		middle = time.perf_counter()
+		losses.sum().backward()
+		running_accuracy = (torch.argmax(y, dim=-1) == labels).float().mean(dim=-1)
+		return losses.detach() / len(labels), running_accuracy, middle - start, time.perf_counter() - middle, len(labels)
+
+	epochs = fit(net, None, configs, optimizer, lr_scheduler, args.epochs, epoch_losses)
+
+	text_log.info("learned parameters")
+	net.print_parameters()
+	train_time = time.perf_counter() - train_start
+	text_log.info("Trained %d configurations for %d epochs in %.2f s" %(len(configs), epochs, train_time))
+	logger.log('train', FOLD, configurations=len(configs), epochs=epochs, train_time=train_time)
+
+	return net
+
+def unbatched_options(args):
+	# options train honours that the stacked configurations of train_batched do not support
+	options = ['--%s' %name for name in ('use_binary_labels', 'use_score_hierarchy', 'activate_linear') if getattr(args, name)]
+	if args.earlystop != 'last':
+		options.append('--earlystop %s' %args.earlystop)
+	if args.optimizer != 'adam':
+		options.append('--optimizer %s' %args.optimizer)
+	return options
+
+def get_folds(dataset, testset, args):
+	if args.setting == 'lopo':
+		return [(dataset.exclude_patient(patient), dataset.get_patient(patient)) for patient in dataset.get_patient_indices()]
+	elif args.setting == 'lovo':
+		return [(dataset.exclude_video(video), dataset.get_video(video)) for video in dataset.get_indices()]
+	elif args.setting == 'kfolds':
+		if args.stratified:
+			splits = dataset.get_stratified_kfold_splits(args.numfolds, dataset.get_score_range())
+		else:
+			splits = dataset.get_kfold_splits(args.numfolds)
+		all = dataset.get_patient_indices()
+		return [(dataset.get_patients(all.difference(split)), dataset.get_patients(split)) for split in splits]
+	else:
+		return [(dataset, testset)]
+
+def get_configurations(args):
+	swept = ('tnorm', 'off_diagonal', 'loss', 'use_sord', 'zero_score_gap')
+	configs = []
+	for values in product(*[getattr(args, name) for name in swept]):
+		config = copy(args)
+		for name, value in zip(swept, values):
+			setattr(config, name, value)
+		config.use_sord = bool(config.use_sord)
+		if config.loss == 'kl' and not config.use_sord:
+			continue
+		if not config.use_sord and config.zero_score_gap != args.zero_score_gap[0]:
+			# the gap only affects sord labels
+			continue
+		configs.append(config)
+	return configs, swept
+
+def sweep(dataset, testset, outprefix, score_range, args):
+
+	configs, swept = get_configurations(args)
+	options = unbatched_options(args)
+	batched = not options
+	if not batched:
+		text_log.info("Training the configurations one at a time because of %s" %", ".join(options))
+		logger.log('unbatched', options=options)
+	groups = {}
+	for i, config in enumerate(configs):
+		key = (config.tnorm, config.off_diagonal) if batched else i
+		groups.setdefault(key, []).append(i)
+
+	# parameters fitted once on all the data for each group, as warm_start does for a single configuration
+	init_states = {}
+	if args.warm_start and args.setting != 'traintest':
+		text_log.info("Warm start computation on all data")
+		for key, group in groups.items():
+			if batched:
+				init_states[key] = train_batched(dataset, score_range, [configs[i] for i in group]).state_dict()
+			else:
+				init_states[key] = train(dataset, "%s_model.%d.all" %(outprefix,group[0]), score_range, configs[group[0]]).state_dict()
+
+	labels = []
+	preds = [[] for config in configs]
+
+	for fold, (trainset, foldtestset) in enumerate(get_folds(dataset, testset, args)):
+		text_log.info("Running fold %d", fold)
+		x, lengths, fold_labels = foldtestset.get_batch()
+		labels.append(fold_labels)
+		for key, group in groups.items():
+			if batched:
+				net = train_batched(trainset, score_range, [configs[i] for i in group], init_states.get(key))
+				with torch.no_grad():
+					group_preds = torch.argmax(net.batch_forward(x, lengths), dim=-1)
+			else:
+				net = train(trainset, "%s_model.%d.%d" %(outprefix,group[0],fold), score_range, configs[group[0]], init_states.get(key))
+				with torch.no_grad():
+					group_preds = torch.argmax(batch_outputs(net, x, lengths), dim=-1).view(1,-1)
+			for i, p in zip(group, group_preds):
+				preds[i].append(p)
+
+	labels = torch.cat(labels)
+	results = []
+	for config, config_preds in zip(configs, preds):
+		metrics = confusion_metrics(confusion(labels, torch.cat(config_preds), score_range))
+		results.append([getattr(config, name) for name in swept] +
+					   [metrics['weighted_f1'], metrics['accuracy'], metrics['covid_nocovid_accuracy']])
+	results = pd.DataFrame(results, columns=list(swept) + ['weighted_f1', 'accuracy', 'covid_nocovid_accuracy'])
+	results.to_csv(outprefix + "_sweep.csv", index=False)
+	text_log.info(results.to_string(float_format='%.3f'))
+	return results
+
+def confusion(labels, preds, score_range):
+	return torch.bincount(labels * score_range + preds, minlength=score_range * score_range).view(score_range, score_range).numpy()
+
+def confusion_metrics(confusion):
+	# weighted precision/recall/f1 as in sklearn (ill-defined ratios count as 0), accuracy and covid/nocovid accuracy
+	support = confusion.sum(1)
+	predicted = confusion.sum(0)
+	tp = np.diag(confusion).astype(float)
+	total = max(support.sum(), 1)
+	precision = np.divide(tp, predicted, out=np.zeros_like(tp), where=predicted > 0)
+	recall = np.divide(tp, support, out=np.zeros_like(tp), where=support > 0)
+	f1 = np.divide(2 * precision * recall, precision + recall, out=np.zeros_like(tp), where=precision + recall > 0)
+	return {'weighted_f1' : (f1 * support).sum() / total,
+			'weighted_precision' : (precision * support).sum() / total,
+			'weighted_recall' : (recall * support).sum() / total,
+			'accuracy' : tp.sum() / total,
+			'covid_nocovid_accuracy' : (confusion[0,0] + confusion[1:,1:].sum()) / total}
 
 def print_results(labels,preds,score_range):
-	print(confusion_matrix(labels,preds))
-	print("\nweighted f1 = %.3f" %f1_score(labels,preds, average='weighted'))
-	print("weighted pre = %.3f" %precision_score(labels,preds, average='weighted'))
-	print("weighted rec = %.3f" %recall_score(labels,preds, average='weighted'))
-	print("accuracy = %.3f" %accuracy_score(labels,preds))
-	print("covid/nocovid accuracy = %.3f\n" %covid_nocovid_accuracy_score(labels, preds))
-	# target_names = ['score %d' %i for i in range(score_range)]
-	# print(classification_report(labels,preds, target_names = ['score 0', 'score 1', 'score 2', 'score 3']))
-
-
-def print_average_results(labels, preds):
-	nfolds=len(labels)
-	weighted_f1 = np.zeros(nfolds)
-	weighted_pre = np.zeros(nfolds)
-	weighted_rec = np.zeros(nfolds)
-	accuracy = np.zeros(nfolds)
-	covid_nocovid_accuracy = np.zeros(nfolds)
-	for i,(l,p) in enumerate(zip(labels, preds),0):			
-		weighted_f1[i]=f1_score(l,p, average='weighted')
-		weighted_pre[i]=precision_score(l,p, average='weighted')
-		weighted_rec[i]=recall_score(l,p, average='weighted')
-		accuracy[i]=accuracy_score(l,p)
-		covid_nocovid_accuracy[i]=covid_nocovid_accuracy_score(l,p)
-	print("weighted f1 = %.3f += %.3f" %(weighted_f1.mean(),weighted_f1.std())) 
-	print("weighted pre = %.3f += %.3f" %(weighted_pre.mean(),weighted_pre.std()))
-	print("weighted rec = %.3f += %.3f" %(weighted_rec.mean(),weighted_rec.std()))
-	print("accuracy = %.3f += %.3f" %(accuracy.mean(),accuracy.std()))
-	print("covid/nocovid accuracy = %.3f += %.3f" %(covid_nocovid_accuracy.mean(),covid_nocovid_accuracy.std()))
+	cm = confusion(labels, preds, score_range)
+	metrics = confusion_metrics(cm)
+	text_log.info("%s", cm)
+	text_log.info("\nweighted f1 = %.3f" %metrics['weighted_f1'])
+	text_log.info("weighted pre = %.3f" %metrics['weighted_precision'])
+	text_log.info("weighted rec = %.3f" %metrics['weighted_recall'])
+	text_log.info("accuracy = %.3f" %metrics['accuracy'])
+	text_log.info("covid/nocovid accuracy = %.3f\n" %metrics['covid_nocovid_accuracy'])
+	metrics['confusion_matrix'] = cm.tolist()
+	return metrics
+
+
+def print_average_results(labels, preds, score_range):
+	metrics = pd.DataFrame([confusion_metrics(confusion(l, p, score_range)) for l,p in zip(labels, preds)])
+	text_log.info("weighted f1 = %.3f += %.3f" %(metrics['weighted_f1'].mean(),metrics['weighted_f1'].std(ddof=0))) 
+	text_log.info("weighted pre = %.3f += %.3f" %(metrics['weighted_precision'].mean(),metrics['weighted_precision'].std(ddof=0)))
+	text_log.info("weighted rec = %.3f += %.3f" %(metrics['weighted_recall'].mean(),metrics['weighted_recall'].std(ddof=0)))
+	text_log.info("accuracy = %.3f += %.3f" %(metrics['accuracy'].mean(),metrics['accuracy'].std(ddof=0)))
+	text_log.info("covid/nocovid accuracy = %.3f += %.3f" %(metrics['covid_nocovid_accuracy'].mean(),metrics['covid_nocovid_accuracy'].std(ddof=0)))
+	return {name : {'mean' : metrics[name].mean(), 'std' : metrics[name].std(ddof=0), 'folds' : metrics[name].tolist()} for name in metrics.columns}
 
 def save_predictions(labels,preds,outputfile):	
 	with open(outputfile, "w") as f:
-		np.savetxt(f, torch.tensor([labels,preds], dtype=torch.int8).t(), fmt='%d') 
-
-def covid_nocovid_accuracy_score(labels, preds):
-	binary_labels = [min(l,1) for l in labels]
-	binary_preds = [min(p,1) for p in preds]
-	return accuracy_score(binary_labels,binary_preds) 		
-
-def compute_roc_curve(inputs, labels, outputs, preds, outprefix, score_range, curve_type='scorewise'):
-
-	if curve_type=='micro_average':
-		onehot_labels = label_binarize(labels, classes=list(range(score_range))).ravel()
-		aggregator_outputs = flatten([softmax(o, dim=0).detach().numpy() for o in outputs])		
-		baseline_outputs = flatten([softmax(torch.mean(x, dim=1), dim=0).numpy() for x in inputs])
-		plot_roc_curve(onehot_labels, aggregator_outputs, baseline_outputs,
-						outprefix + "_roc_micro_average", 
-						"Micro-averaged ROC curve")
-	elif curve_type=='binary_classification':
-		binary_labels = [min(l,1) for l in labels]
-		aggregator_outputs = [torch.sum(softmax(o, dim=0)[1:]).detach().numpy() for o in outputs]		
-		baseline_outputs = [torch.sum(softmax(torch.mean(x,dim=1), dim=0)[1:]) for x in inputs]
-		plot_roc_curve(binary_labels, aggregator_outputs, baseline_outputs,
-						outprefix + "_roc_binary_classification", 
-						"Covid/NoCovid ROC curve")
-	if curve_type=='scorewise':
-		for s in range(score_range):
-			score_labels = [l == s and 1 or 0 for l in labels]
-			aggregator_outputs = [softmax(o, dim=0)[s].detach().numpy() for o in outputs]		
-			baseline_outputs = [softmax(torch.mean(x,dim=1), dim=0)[s] for x in inputs]
-			plot_roc_curve(score_labels, aggregator_outputs, baseline_outputs,
-							"%s_roc_score_%d" %(outprefix,s), 
-							"ROC curve for score %d" %s)
-	else:
-		raise Exception("Unknown curve_type <%s> for roc_curve computation" %curve_type)
-
-def plot_roc_curve(labels, aggregator_outputs, baseline_outputs, fileprefix, title):
-		
-	aggregator_fpr, aggregator_tpr, _ = roc_curve(labels, aggregator_outputs)
-	aggregator_roc_auc = roc_auc_score(labels, aggregator_outputs)
-	baseline_fpr, baseline_tpr, _ = roc_curve(labels, baseline_outputs)
-	baseline_roc_auc = roc_auc_score(labels, baseline_outputs)
-	curve_file = fileprefix + ".pdf"
-	data_file = fileprefix + ".pkl"	
-	with open(data_file, "wb") as f:
-		pickle.dump((aggregator_fpr, aggregator_tpr, aggregator_roc_auc), f)
-		pickle.dump((baseline_fpr, baseline_tpr, baseline_roc_auc), f)
-	print("Saving ROC curve to file: " + curve_file)
-	plt.clf()
-	plt.plot(aggregator_fpr, aggregator_tpr, color='blue', label='video-based predictor (AUC = %.2f)' %aggregator_roc_auc)
-	plt.plot(baseline_fpr, baseline_tpr, color='green', label='mean baseline (AUC = %.2f)' %baseline_roc_auc)
-	plt.xlabel('False Positive Rate')
-	plt.ylabel('True Positive Rate')
-	plt.title(title)
-	plt.legend(loc="lower right")
-	plt.savefig(curve_file)
-
+		np.savetxt(f, torch.stack((labels, preds)).t().to(torch.int8), fmt='%d') 
 
+def save_results(results, outputfile):
+	with open(outputfile, "w") as f:
+		json.dump(results, f, indent=1, default=float)
+
+ROC_PREDICTORS = ('video-based predictor', 'mean baseline')
+
+def compute_roc_curve(labels, outputs, mean_inputs, outprefix, score_range):
+	# scorewise (one-vs-rest) curves of the aggregator and of the mean baseline, plotted on request by roc_report.py
+	if outputs.shape[-1] == 2 and mean_inputs.shape[-1] > 2:
+		# covid/no covid outputs: the baseline is compared on its no covid and summed covid scores
+		mean_inputs = torch.stack((mean_inputs[:,0], torch.sum(mean_inputs[:,1:], dim=-1)), dim=-1)
+	probabilities = softmax(torch.stack((outputs, mean_inputs)), dim=-1).numpy()
+	fpr, tpr, auc = roc_curves(probabilities, labels.numpy())
+	roc_file = outprefix + "_roc.npz"
+	np.savez_compressed(roc_file, fpr=fpr, tpr=tpr, auc=auc, predictors=np.array(ROC_PREDICTORS))
+	for s in range(auc.shape[1]):
+		text_log.info("ROC AUC for score %d: %s" %(s, ", ".join("%s = %.3f" %(name, auc[k,s]) for k,name in enumerate(ROC_PREDICTORS))))
+	text_log.info("Saving ROC curves to file: " + roc_file)
@@ -28,6 +28,17 @@ def max_thres_count_argmax_10(x):
 def max_thres_count_argmax_15(x):
 	return max_thres_count_argmax(x, 0.15)
 
+def batch_mean(x, lengths):
+	# mean over the frames of a zero padded (videos, scores, frames) batch
+	return torch.sum(x,dim=-1) / lengths.unsqueeze(-1).float()
+
+def batch_argmax_mean(x, lengths):
+	return torch.argmax(batch_mean(x, lengths),dim=-1)
+
+def batch_max_argmax(x, lengths):
+	# padded frames have argmax 0 and cannot raise the maximum
+	return torch.max(torch.argmax(x,dim=1),dim=-1).values
+
 def sord_labels(label, num_classes, zero_score_gap=0.5):
 	batch_size = label.shape[0]
 	labels_sord = np.zeros((batch_size, num_classes))
@@ -45,22 +56,52 @@ def sord_labels(label, num_classes, zero_score_gap=0.5):
 	labels_sord = torch.from_numpy(labels_sord)#.cuda(non_blocking=True)
 	return F.softmax(-labels_sord, dim=1)
 
-def cross_entropy_loss(y, label, use_sord=False, zero_score_gap=0.5, weight=None):
+def reduce_loss(loss, reduction):
+	if reduction == 'none':
+		return loss
+	elif reduction == 'mean':
+		return loss.mean()
+	else:
+		raise Exception('Unknown reduction: ' + reduction)
+
+def cross_entropy_loss(y, label, use_sord=False, zero_score_gap=0.5, weight=None, reduction='mean'):
 	if use_sord:
-		labels = sord_labels(label, y.shape[1], zero_score_gap)
+		labels = sord_labels(label, y.shape[-1], zero_score_gap)
 	else:
-		labels = torch.zeros(y.shape[1])
-		labels[label] = 1
-	log_predictions = F.log_softmax(y, 1)
+		labels = F.one_hot(label, y.shape[-1]).float()
+	log_predictions = F.log_softmax(y, -1)
 	if weight != None:
-		return (-weight * labels * log_predictions).sum(dim=1).mean()
+		return reduce_loss((-weight * labels * log_predictions).sum(dim=-1), reduction)
 	else:
-		return (-labels * log_predictions).sum(dim=1).mean()	
+		return reduce_loss((-labels * log_predictions).sum(dim=-1), reduction)
 
-def kl_div_loss(y, label, use_sord=True, zero_score_gap=0.5, weight=None):
+def kl_div_loss(y, label, use_sord=True, zero_score_gap=0.5, weight=None, reduction='mean'):
 	assert(use_sord)
 	assert(weight == None)
-	label = sord_labels(label, y.shape[1], zero_score_gap).float()
-	log_predictions = F.log_softmax(y, 1)
-	loss = torch.nn.KLDivLoss(reduction='batchmean')
-	return loss(y, label)
+	label = sord_labels(label, y.shape[-1], zero_score_gap).float()
+	return reduce_loss(F.kl_div(y, label, reduction='none').sum(dim=-1), reduction)
+
+def roc_curves(probabilities, labels):
+	"""One-vs-rest ROC curves for every (predictor, score) pair at once
+	probabilities: (predictors, videos, scores) array, labels: (videos,) array of scores
+	returns fpr and tpr as (predictors, scores, videos + 1) arrays and the (predictors, scores) AUCs.
+	Points inside a group of tied probabilities are moved to the end of the group, so that
+	the curve has one point per distinct threshold (repeated) and the trapezoidal AUC matches sklearn.
+	"""
+	probabilities = np.moveaxis(probabilities, 1, -1)
+	positives = labels[np.newaxis,:] == np.arange(probabilities.shape[1])[:,np.newaxis]
+	order = np.argsort(-probabilities, axis=-1, kind='mergesort')
+	sorted_probabilities = np.take_along_axis(probabilities, order, axis=-1)
+	sorted_positives = np.take_along_axis(np.broadcast_to(positives, probabilities.shape), order, axis=-1)
+	tps = np.cumsum(sorted_positives, axis=-1)
+	fps = np.cumsum(~sorted_positives, axis=-1)
+	n = probabilities.shape[-1]
+	group_last = np.concatenate((sorted_probabilities[...,1:] != sorted_probabilities[...,:-1], np.ones(probabilities.shape[:-1] + (1,), dtype=bool)), axis=-1)
+	group_end = np.minimum.accumulate(np.where(group_last, np.arange(n), n)[...,::-1], axis=-1)[...,::-1]
+	zeros = np.zeros(probabilities.shape[:-1] + (1,))
+	tps = np.concatenate((zeros, np.take_along_axis(tps, group_end, axis=-1)), axis=-1)
+	fps = np.concatenate((zeros, np.take_along_axis(fps, group_end, axis=-1)), axis=-1)
+	with np.errstate(invalid='ignore', divide='ignore'):
+		tpr = tps / tps[...,-1:]
+		fpr = fps / fps[...,-1:]
+	return fpr, tpr, np.trapz(tpr, fpr, axis=-1)
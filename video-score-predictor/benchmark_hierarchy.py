@@ -0,0 +1,38 @@
+import argparse
+import time
+import torch
+from torch.nn.utils.rnn import pad_sequence
+from aggregator.nn import ScoreHierarchyNet, CovidNoCovidNet
+
+# Compares the per-video forward loop with the batched forward of the hierarchical heads on random frame scores
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--videos", default=200, type=int)
+parser.add_argument("--num_scores", default=4, type=int)
+parser.add_argument("--min_frames", default=20, type=int)
+parser.add_argument("--max_frames", default=300, type=int)
+parser.add_argument("--repeats", default=5, type=int)
+parser.add_argument("--tnorm", default="product", choices=['lukasiewicz', 'product'])
+parser.add_argument("--off_diagonal", default="min", choices=['min', 'max'])
+parser.add_argument("--seed", default=0, type=int)
+args = parser.parse_args()
+
+torch.manual_seed(args.seed)
+videos = [torch.softmax(torch.randn(args.num_scores, torch.randint(args.min_frames, args.max_frames + 1, (1,)).item()), dim=0) for i in range(args.videos)]
+lengths = torch.tensor([x.shape[1] for x in videos])
+batch = pad_sequence([x.t() for x in videos], batch_first=True).permute(0,2,1)
+
+def timed(function):
+	times = []
+	for r in range(args.repeats):
+		start = time.perf_counter()
+		outputs = function()
+		outputs.sum().backward()
+		times.append(time.perf_counter() - start)
+	return outputs.detach(), min(times)
+
+for name, net in (('ScoreHierarchyNet', ScoreHierarchyNet(args.num_scores, tnorm=args.tnorm, init_neutral=0.5, off_diagonal=args.off_diagonal)),
+				  ('CovidNoCovidNet', CovidNoCovidNet(args.num_scores, tnorm=args.tnorm, init_neutral=0.5, off_diagonal=args.off_diagonal))):
+	loop_outputs, loop_time = timed(lambda: torch.stack([net(x) for x in videos]))
+	batch_outputs, batch_time = timed(lambda: net.batch_forward(batch, lengths))
+	print("%s: per-video loop %.1f ms, batched %.1f ms (%.1fx), max abs difference %.2e" %(name, loop_time * 1000, batch_time * 1000, loop_time / batch_time, (loop_outputs - batch_outputs).abs().max()))
@@ -0,0 +1,10 @@
+from aggregator.data import save_columnar_predictions
+import argparse
+
+# Converts pickled frame predictions to the memory-mappable columnar layout accepted as datafile by aggregator.py
+parser = argparse.ArgumentParser()
+parser.add_argument("datafile")
+parser.add_argument("outputdir")
+args = parser.parse_args()
+
+save_columnar_predictions(args.datafile, args.outputdir)
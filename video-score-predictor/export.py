@@ -0,0 +1,39 @@
+import argparse
+import torch
+from aggregator.script import load_script_net, VideoScorer
+from aggregator.trainer import load_net
+
+# Compiles a trained aggregator with TorchScript, optionally behind a TorchScript frame model, into a single file
+# that can be loaded with torch.jit.load (or torch::jit::load in C++)
+parser = argparse.ArgumentParser()
+parser.add_argument("modelfile", help="Aggregator state_dict saved by aggregator.py")
+parser.add_argument("outputfile")
+parser.add_argument("--frame_model", default=None, help="TorchScript frame model, e.g. torch.jit.trace of CNNConStn; without it only the aggregator is exported")
+parser.add_argument("--num_scores", default=4, type=int)
+parser.add_argument("--tnorm", default="product", choices=['lukasiewicz', 'product'])
+parser.add_argument("--off_diagonal", default="min", choices=['min', 'mean', 'max'])
+parser.add_argument("--normalize_neutral", action='store_true', default=False)
+args = parser.parse_args()
+args.use_binary_labels = False
+args.use_score_hierarchy = False
+args.init_neutral = 0.
+
+net = load_script_net(args.modelfile, args.num_scores, args)
+net.eval()
+
+# the compiled aggregator has to agree with the Python one on the same weights, for odd and power of two lengths
+python_net = load_net(args.modelfile, args.num_scores, args)
+script_net = torch.jit.script(net)
+difference = 0.
+with torch.no_grad():
+	for num_frames in (1, 2, 3, 7, 16, 37, 100):
+		x = torch.softmax(torch.randn(args.num_scores, num_frames), dim=0)
+		difference = max(difference, (python_net(x) - script_net(x)).abs().max().item())
+print("Max abs difference to the Python aggregator: %.2e" %difference)
+
+if args.frame_model:
+	module = torch.jit.script(VideoScorer(torch.jit.load(args.frame_model), net))
+else:
+	module = torch.jit.script(net)
+module.save(args.outputfile)
+print("Saved", args.outputfile)
@@ -0,0 +1,71 @@
+import asyncio
+import argparse
+import json
+import random
+import time
+import numpy as np
+
+# Load generator for serve.py: concurrent keep-alive clients posting random frame-score matrices
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--host", default="127.0.0.1")
+parser.add_argument("--port", default=8000, type=int)
+parser.add_argument("--socket", default=None)
+parser.add_argument("--concurrency", default=16, type=int)
+parser.add_argument("--requests", default=2000, type=int, help="Total number of requests")
+parser.add_argument("--num_scores", default=4, type=int)
+parser.add_argument("--min_frames", default=20, type=int)
+parser.add_argument("--max_frames", default=300, type=int)
+parser.add_argument("--seed", default=0, type=int)
+args = parser.parse_args()
+
+async def connect():
+	if args.socket:
+		return await asyncio.open_unix_connection(args.socket)
+	return await asyncio.open_connection(args.host, args.port)
+
+async def request(reader, writer, method, target, body=b''):
+	writer.write(('%s %s HTTP/1.1\r\nHost: %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n' %(method, target, args.host, len(body))).encode() + body)
+	await writer.drain()
+	status = int((await reader.readline()).split()[1])
+	length = 0
+	while True:
+		line = await reader.readline()
+		if line in (b'\r\n', b'\n', b''):
+			break
+		name, value = line.decode().split(':', 1)
+		if name.strip().lower() == 'content-length':
+			length = int(value)
+	return status, json.loads(await reader.readexactly(length))
+
+def random_video(rng):
+	frames = rng.randint(args.min_frames, args.max_frames)
+	scores = np.array([[rng.random() for s in range(args.num_scores)] for f in range(frames)])
+	return json.dumps({'scores' : (scores / scores.sum(1, keepdims=True)).tolist()}).encode()
+
+async def client(bodies, latencies):
+	reader, writer = await connect()
+	for body in bodies:
+		start = time.perf_counter()
+		status, response = await request(reader, writer, 'POST', '/predict', body)
+		if status != 200:
+			raise Exception('Request failed: ' + str(response))
+		latencies.append(time.perf_counter() - start)
+	writer.close()
+
+async def main():
+	rng = random.Random(args.seed)
+	bodies = [random_video(rng) for i in range(args.requests)]
+	latencies = []
+	start = time.perf_counter()
+	await asyncio.gather(*[client(bodies[i::args.concurrency], latencies) for i in range(args.concurrency)])
+	elapsed = time.perf_counter() - start
+	latencies = np.array(latencies) * 1000
+	print("requests = %d in %.2f s (%.1f videos/sec)" %(len(latencies), elapsed, len(latencies) / elapsed))
+	print("latency mean = %.2f ms, p50 = %.2f ms, p95 = %.2f ms, p99 = %.2f ms" %(latencies.mean(), np.percentile(latencies, 50), np.percentile(latencies, 95), np.percentile(latencies, 99)))
+	reader, writer = await connect()
+	print("server stats")
+	print(json.dumps((await request(reader, writer, 'GET', '/stats'))[1], indent=1))
+	writer.close()
+
+asyncio.run(main())
@@ -0,0 +1,28 @@
+import argparse
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+# Plots the ROC curves saved by an aggregator run (<expname>_roc.npz), one pdf per score
+parser = argparse.ArgumentParser()
+parser.add_argument("rocfile")
+parser.add_argument("--outprefix", default=None, help="Prefix of the pdf files (defaults to the rocfile prefix)")
+args = parser.parse_args()
+
+outprefix = args.outprefix
+if outprefix is None:
+	outprefix = args.rocfile[:-len("_roc.npz")] if args.rocfile.endswith("_roc.npz") else args.rocfile
+roc = np.load(args.rocfile)
+colors = ('blue', 'green')
+for s in range(roc['auc'].shape[1]):
+	curve_file = "%s_roc_score_%d.pdf" %(outprefix,s)
+	print("Saving ROC curve to file: " + curve_file)
+	plt.clf()
+	for k,name in enumerate(roc['predictors']):
+		plt.plot(roc['fpr'][k,s], roc['tpr'][k,s], color=colors[k % len(colors)], label='%s (AUC = %.2f)' %(name, roc['auc'][k,s]))
+	plt.xlabel('False Positive Rate')
+	plt.ylabel('True Positive Rate')
+	plt.title("ROC curve for score %d" %s)
+	plt.legend(loc="lower right")
+	plt.savefig(curve_file)
@@ -0,0 +1,33 @@
+import asyncio
+import argparse
+from aggregator.trainer import load_net
+from aggregator.nn import Ensemble
+from aggregator.service import BatchingService
+
+# Long-running scoring service for a trained aggregator checkpoint, see aggregator/service.py for the endpoints
+parser = argparse.ArgumentParser()
+parser.add_argument("modelfiles", nargs='+', help="Several models, e.g. the kfolds fold models, are served as an ensemble")
+parser.add_argument("--ensemble", default="mean", choices=['min', 'mean', 'max'])
+parser.add_argument("--num_scores", default=4, type=int)
+parser.add_argument("--tnorm", default="product", choices=['lukasiewicz', 'product'])
+parser.add_argument("--off_diagonal", default="min", choices=['min', 'mean', 'max'])
+parser.add_argument("--normalize_neutral", action='store_true', default=False)
+parser.add_argument("--use_binary_labels", action='store_true', default=False)
+parser.add_argument("--use_score_hierarchy", action='store_true', default=False)
+parser.add_argument("--init_neutral", default=0., type=float)
+parser.add_argument("--host", default="127.0.0.1")
+parser.add_argument("--port", default=8000, type=int)
+parser.add_argument("--socket", default=None, help="Serve on a Unix socket instead of host:port")
+parser.add_argument("--max_batch", default=64, type=int, help="Maximum number of videos in a forward")
+parser.add_argument("--max_delay", default=0.002, type=float, help="Seconds waited for more requests before a forward")
+args = parser.parse_args()
+
+if len(args.modelfiles) == 1:
+	net = load_net(args.modelfiles[0], args.num_scores, args)
+else:
+	net = Ensemble(args.ensemble)
+	for modelfile in args.modelfiles:
+		net.add_predictor(load_net(modelfile, args.num_scores, args))
+net.eval()
+service = BatchingService(net, args.num_scores, max_batch=args.max_batch, max_delay=args.max_delay)
+asyncio.run(service.run(args.host, args.port, args.socket))
@@ -0,0 +1,31 @@
+from aggregator.data import patientDataset
+from aggregator.trainer import sweep
+from aggregator.arguments import get_parser
+from aggregator.logger import logger
+from datetime import datetime
+import time
+from os import path, mkdir
+
+# Trains every combination of the swept settings on the same folds, loading the data only once
+args = get_parser(sweep=True).parse_args()
+start = time.perf_counter()
+
+dataset = patientDataset(args.datafile, args.labelfile, args.mapfile, use_majority_label=args.use_majority_label, use_binary_labels=args.use_binary_labels, label_cache=args.label_cache)
+
+workdir = path.join(args.outputdir, datetime.now().isoformat())
+mkdir(workdir)
+outprefix = path.join(workdir, args.expname)
+logger.open(outprefix + ".jsonl", args.verbosity)
+logger.log('start', args=vars(args), load_time=time.perf_counter() - start)
+
+if args.testfile:
+	testset = patientDataset(args.testfile, args.labelfile, args.mapfile, use_majority_label=args.use_majority_label, use_binary_labels=args.use_binary_labels, label_cache=args.label_cache)
+else:
+	testset = dataset
+
+score_range = dataset.get_score_range()
+
+sweep(dataset, testset, outprefix, score_range, args)
+
+logger.log('end', total_time=time.perf_counter() - start)
+logger.close()
@@ -0,0 +1,5 @@
+import sys
+from os import path
+
+# the tests import the aggregator package the way the scripts in video-score-predictor do
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
@@ -0,0 +1,35 @@
+import pandas as pd
+
+from aggregator import data
+
+
+def annotator_tables(monkeypatch, tables):
+    # one label table per annotator file, as read from the Excel files of the label directory
+    files = ['Score%d.xlsx' %i for i in range(len(tables))]
+    monkeypatch.setattr(data, 'label_files', lambda labeldir: files)
+    monkeypatch.setattr(data.pd, 'read_excel', lambda filename: tables[files.index(filename)])
+
+
+def test_majority_label_ties(monkeypatch):
+    annotator_tables(monkeypatch, [pd.DataFrame({'Video' : ['a', 'b', 'c'], 'Score' : [1, 0, 2]}),
+                                   pd.DataFrame({'Video' : ['a', 'b', 'c'], 'Score' : [1, 3, 2]}),
+                                   pd.DataFrame({'Video' : ['a', 'b', 'c'], 'Score' : [2, 2, 0]})])
+    labels = data.majority_label('labels').set_index('Video')['Score']
+    # a and c have a single mode, the modes of b are tied and the highest one wins
+    assert labels.to_dict() == {'a' : 1, 'b' : 3, 'c' : 2}
+
+
+def test_majority_label_partial_overlap(monkeypatch):
+    annotator_tables(monkeypatch, [pd.DataFrame({'Video' : ['a', 'b'], 'Score' : [1, 0]}),
+                                   pd.DataFrame({'Video' : ['b', 'c'], 'Score' : [2, 2]})])
+    labels = data.majority_label('labels')
+    assert labels['Video'].tolist() == ['b']
+    assert labels['Score'].tolist() == [2]
+
+
+def test_majority_label_empty_overlap(monkeypatch):
+    annotator_tables(monkeypatch, [pd.DataFrame({'Video' : ['a'], 'Score' : [1]}),
+                                   pd.DataFrame({'Video' : ['b'], 'Score' : [2]})])
+    labels = data.majority_label('labels')
+    assert labels.empty
+    assert list(labels.columns) == ['Video', 'Score']
@@ -0,0 +1,37 @@
+import pytest
+import torch
+
+from aggregator.nn import UninormAggregator, TNORMS, OFF_DIAGONALS
+
+
+@pytest.mark.parametrize('tnorm', sorted(TNORMS))
+@pytest.mark.parametrize('off_diagonal', sorted(OFF_DIAGONALS))
+@pytest.mark.parametrize('normalize_neutral', [False, True])
+def test_stream_matches_forward(tnorm, off_diagonal, normalize_neutral):
+    torch.manual_seed(0)
+    aggregator = UninormAggregator(4, tnorm, normalize_neutral, off_diagonal=off_diagonal)
+    aggregator.init_params(torch.tensor([0.2, 0.4, 0.6, 0.8]))
+    for num_frames in [1, 2, 3, 5, 7, 16, 37]:
+        x = torch.rand(4, num_frames)
+        expected = aggregator(x).detach()
+        stream = aggregator.stream(num_frames)
+        for frame in x.t():
+            stream.update(frame)
+        assert torch.allclose(stream.score(), expected, atol=1e-5)
+        # chunks of frames give the same brackets
+        stream = aggregator.stream(num_frames)
+        for chunk in torch.split(x, 3, dim=1):
+            stream.update(chunk)
+        assert torch.allclose(stream.score(), expected, atol=1e-5)
+
+
+def test_stream_without_length():
+    aggregator = UninormAggregator(2, off_diagonal='mean')
+    with pytest.raises(Exception):
+        aggregator.stream()
+    aggregator = UninormAggregator(2, off_diagonal='max')
+    aggregator.init_params(torch.tensor([0.3, 0.6]))
+    x = torch.rand(2, 9)
+    stream = aggregator.stream()
+    stream.update(x)
+    assert torch.allclose(stream.score(), aggregator(x).detach(), atol=1e-5)